@@ -1,35 +1,58 @@
 import os
 
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
+try:
+    from fastapi.sse import EventSourceResponse, ServerSentEvent
+except ImportError:  # FastAPI < 0.135 has no native SSE support
+    EventSourceResponse = None
+    ServerSentEvent = None
+
 from models import (
     ChatRequest,
     DraftRequest,
+    EmailBodiesRequest,
     GmailSendRequest,
     Prompts,
     Settings,
 )
-from services.gmail import GmailService
-from services.inbox import inbox_service, DATA_DIR
-from services.llm import llm_service
-from services.rag import rag_service
+from services.gmail import GmailService, LABEL_CATEGORIES
+from services.inbox import inbox_service, DATA_DIR, _write_json_atomic
+from services.llm import LLMStreamError, llm_service
+from services.rag import EmbeddingUnavailable, get_rag_service
 import json
 import asyncio
+import hashlib
+import re
+import threading
 import uuid
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+import orjson
 
 os.makedirs(DATA_DIR, exist_ok=True)
 TOKEN_FILE = os.path.join(DATA_DIR, "gmail_token.json")
 CREDENTIALS_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "credentials.json")
 
+# Sources holding drafts rather than received emails
+DRAFT_SOURCES = ("draft", "mock_draft", "gmail_draft")
+
 gmail_service = GmailService(
     credentials_file=CREDENTIALS_FILE,
     token_file=TOKEN_FILE,
 )
 
-app = FastAPI(title="Email Productivity Agent Backend")
+class ORJSONResponse(JSONResponse):
+    """JSON response serialized with orjson, which is much faster for large email lists."""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(title="Email Productivity Agent Backend", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -43,6 +66,16 @@ app.add_middleware(
 def startup_event():
     settings = inbox_service.get_settings()
     llm_service.update_settings(settings.get("llm_provider"), settings.get("groq_api_key"))
+    load_category_cache()
+    # Emails from the pre-cosine collection are re-indexed without holding up startup
+    if get_rag_service().migrate_legacy_collection():
+        threading.Thread(target=index_all_emails, name="rag-reindex", daemon=True).start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    save_category_cache()
+    await llm_service.close()
+    await get_rag_service().close()
 
 @app.get("/")
 def read_root():
@@ -51,15 +84,34 @@ def read_root():
 @app.get("/emails")
 def get_emails(limit: int = 20):
     """Get emails from inbox, limited to most recent by default"""
-    all_emails = inbox_service.get_emails()
-    # Sort by timestamp descending (most recent first)
-    sorted_emails = sorted(
-        all_emails,
-        key=lambda x: x.get('timestamp', ''),
-        reverse=True
-    )
-    # Return only the most recent emails based on limit
-    return sorted_emails[:limit]
+    # Most recent first; the ordering is cached by the inbox service
+    return inbox_service.get_recent_emails(limit)
+
+def load_email_bodies(emails: List[Dict]) -> List[Dict]:
+    """Download bodies for Gmail messages that were synced with headers only"""
+    missing = [e["id"] for e in emails if e.get("body_loaded") is False]
+    if missing and gmail_service.is_authenticated():
+        try:
+            # Records are updated in place by the inbox service
+            gmail_service.fetch_full_bodies(missing)
+        except Exception as e:
+            print(f"Error loading email bodies: {e}")
+    return emails
+
+@app.post("/emails/bodies")
+def get_email_bodies(request: EmailBodiesRequest):
+    """Get several emails (e.g. a thread), downloading missing bodies in one Gmail batch"""
+    emails = [e for e in (inbox_service.get_email(i) for i in request.ids) if e]
+    return load_email_bodies(emails)
+
+@app.get("/emails/{email_id}")
+def get_email(email_id: str):
+    """Get a single email, downloading its body on first open"""
+    email = inbox_service.get_email(email_id)
+    if not email:
+        raise HTTPException(status_code=404, detail="Email not found")
+    load_email_bodies([email])
+    return email
 
 @app.get("/gmail/status")
 def gmail_status():
@@ -75,7 +127,7 @@ def gmail_oauth_callback(code: str, state: str):
     gmail_service.finish_auth(state=state, code=code)
     # Clear mock inbox embeddings when logging in to Gmail
     # This ensures only Gmail emails are in the RAG system
-    rag_service.clear_mock_inbox_embeddings()
+    get_rag_service().clear_mock_inbox_embeddings()
     html = """
     <html>
         <head><title>Gmail Connected</title></head>
@@ -101,12 +153,12 @@ def gmail_sync(full: bool = False):
 def gmail_logout():
     gmail_service.logout()
     # Clear all Gmail email embeddings from RAG when disconnecting
-    rag_service.clear_gmail_embeddings()
+    get_rag_service().clear_gmail_embeddings()
     return gmail_service.get_status()
 
 @app.post("/gmail/send")
-def gmail_send(request: GmailSendRequest):
-    return gmail_service.send_message(
+def gmail_send(request: GmailSendRequest, background_tasks: BackgroundTasks):
+    result = gmail_service.send_message(
         to=request.to,
         cc=request.cc,
         bcc=request.bcc,
@@ -115,111 +167,244 @@ def gmail_send(request: GmailSendRequest):
         thread_id=request.thread_id,
         in_reply_to=request.in_reply_to,
     )
-
-@app.post("/ingest")
-async def ingest_emails():
-    """Stream email processing updates in real-time using SSE"""
-    async def generate():
-        # Get all emails first
-        all_emails = inbox_service.get_emails()
-        
-        # Filter based on Gmail authentication status
-        gmail_authenticated = gmail_service.is_authenticated()
-        
-        if gmail_authenticated:
-            # Only ingest Gmail emails
-            current_emails = [e for e in all_emails if e.get("source") == "gmail"]
-            email_type = "Gmail"
-        else:
-            # Only ingest mock/system emails (exclude Gmail)
-            current_emails = [e for e in all_emails if e.get("source") != "gmail"]
-            email_type = "Mock/System"
-        
-        prompts = inbox_service.get_prompts()
-        
-        cat_prompt_template = prompts["categorization"]["template"]
-        action_prompt_template = prompts["action_items"]["template"]
-        
-        total = len(current_emails)
-        error_occurred = False
-        
-        # Send initial status indicating which emails are being ingested
-        yield f"data: {json.dumps({'type': 'status', 'message': f'Ingesting {email_type} emails ({total} total)...'})}\n\n"
-        
-        # PHASE 1: Fast category tagging - stream immediately
-        for idx, email in enumerate(current_emails):
-            # Categorize every email via LLM
-            prompt = f"{cat_prompt_template}\n\nEmail Body:\n{email['body']}\n\nIMPORTANT: Return ONLY the category name (e.g. 'Work', 'Personal', 'Newsletter', 'Finance'). Do not add any other text."
-            category = llm_service.generate(prompt)
-            
-            # Check if LLM returned an error
-            if category.startswith("Error calling Groq") or category.startswith("Error calling Ollama"):
-                if not error_occurred:
-                    error_occurred = True
-                    yield f"data: {json.dumps({'type': 'error', 'message': category})}\n\n"
-                    return
-                
-            email["category"] = category.strip()
+    # Pull the sent copy into the local inbox without making the client wait for it
+    background_tasks.add_task(gmail_service.refresh_sent_message, result["message_id"])
+    return result
+
+# Number of emails sent to the LLM together during ingestion
+INGEST_BATCH_SIZE = 16
+
+# Outermost {...} span of an LLM response that wraps JSON in extra text
+JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+def is_llm_error(response: str) -> bool:
+    return response.startswith("Error calling Groq") or response.startswith("Error calling Ollama")
+
+def needs_category(email: Dict) -> bool:
+    category = email.get("category")
+    if not category:
+        return True
+    # Gmail records arrive with a placeholder category taken from system labels
+    return email.get("source") == "gmail" and category in LABEL_CATEGORIES
+
+# Prompt builders -----------------------------------------------------------
+# Static instructions come first so every request of a kind shares a
+# byte-identical prefix that providers can cache; the email goes last.
+
+CATEGORY_INSTRUCTIONS = "IMPORTANT: Return ONLY the category name (e.g. 'Work', 'Personal', 'Newsletter', 'Finance'). Do not add any other text."
+
+def email_block(content: str) -> str:
+    return f"--- EMAIL START ---\n{content}\n--- EMAIL END ---"
+
+def build_categorization_prompt(template: str, body: str) -> str:
+    return f"{template}\n\n{CATEGORY_INSTRUCTIONS}\n\n{email_block(body)}"
+
+def build_action_items_prompt(template: str, body: str) -> str:
+    return f"{template}\n\n{email_block(body)}"
+
+def build_auto_reply_prompt(template: str, email: Dict, instructions: Optional[str] = None) -> str:
+    original = f"From: {email['sender']}\nSubject: {email['subject']}\nBody: {email['body']}"
+    prompt = f"{template}\n\nDraft a reply to the original email below.\n\n{email_block(original)}"
+    if instructions:
+        prompt += f"\n\nAdditional Instructions: {instructions}"
+    return prompt + "\n\nDraft a reply:"
+
+# Categorization cache ------------------------------------------------------
+
+CATEGORY_CACHE_FILE = os.path.join(DATA_DIR, "category_cache.json")
+CATEGORY_CACHE_SIZE = 4096
+
+# Cheap keyword rules for obvious emails that don't need an LLM call, each with the
+# categories it can answer. A rule only applies when the user's categorization prompt
+# names one of them, so it never assigns a category outside the user's taxonomy
+CATEGORY_RULES = [
+    (re.compile(r"\bunsubscribe\b", re.IGNORECASE), ("Newsletter", "News", "Promotions")),
+    (re.compile(r"\b(invoice|receipt)s?\b", re.IGNORECASE), ("Finance", "Receipts", "Bills")),
+]
+
+# Maps a hash of (categorization prompt, normalized body) to the LLM's answer
+category_cache: Dict[str, str] = {}
+
+def category_cache_key(template: str, body: str) -> Optional[str]:
+    """None for an empty body, whose category says nothing about other empty bodies"""
+    normalized = " ".join(body.lower().split())
+    if not normalized:
+        return None
+    return hashlib.blake2b(f"{template}\n{normalized}".encode(), digest_size=16).hexdigest()
+
+def category_patterns(template: str) -> List[Tuple[re.Pattern, str]]:
+    """The keyword rules usable with a categorization prompt, answering in the prompt's spelling"""
+    patterns = []
+    for pattern, names in CATEGORY_RULES:
+        for name in names:
+            match = re.search(rf"\b{name}\b", template, re.IGNORECASE)
+            if match:
+                patterns.append((pattern, match.group(0)))
+                break
+    return patterns
+
+def lookup_category(key: Optional[str], body: str, patterns: List[Tuple[re.Pattern, str]]) -> Optional[str]:
+    for pattern, category in patterns:
+        if pattern.search(body):
+            return category
+    return category_cache.get(key) if key else None
+
+def store_category(key: Optional[str], category: str):
+    if not key:
+        return
+    category_cache[key] = category
+    # Evict the oldest entries once the cache is full (dicts keep insertion order)
+    while len(category_cache) > CATEGORY_CACHE_SIZE:
+        category_cache.pop(next(iter(category_cache)))
+
+def load_category_cache():
+    if os.path.exists(CATEGORY_CACHE_FILE):
+        try:
+            with open(CATEGORY_CACHE_FILE, 'r') as f:
+                category_cache.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Could not load category cache: {e}")
+
+def save_category_cache():
+    _write_json_atomic(CATEGORY_CACHE_FILE, category_cache)
+
+async def ingest_events():
+    """Process the inbox and yield one progress payload per SSE event"""
+    # Filter based on Gmail authentication status
+    gmail_authenticated = gmail_service.is_authenticated()
+    
+    if gmail_authenticated:
+        # Only ingest Gmail emails
+        current_emails = inbox_service.get_by_source("gmail")
+        email_type = "Gmail"
+    else:
+        # Only ingest mock/system emails (exclude Gmail)
+        current_emails = inbox_service.get_excluding_sources({"gmail"})
+        email_type = "Mock/System"
+    
+    prompts = inbox_service.get_prompts()
+    
+    cat_prompt_template = prompts["categorization"]["template"]
+    action_prompt_template = prompts["action_items"]["template"]
+    rule_patterns = category_patterns(cat_prompt_template)
+    
+    # Categorization and action items need the bodies skipped during sync
+    await asyncio.to_thread(load_email_bodies, current_emails)
+    # Emails whose body still couldn't be downloaded are left for a later run,
+    # rather than being categorized (and indexed) from an empty body
+    unloaded = sum(1 for e in current_emails if e.get("body_loaded") is False)
+    if unloaded:
+        current_emails = [e for e in current_emails if e.get("body_loaded") is not False]
+    
+    total = len(current_emails)
+    
+    # Send initial status indicating which emails are being ingested
+    yield {'type': 'status', 'message': f'Ingesting {email_type} emails ({total} total)...'}
+    if unloaded:
+        yield {'type': 'status', 'message': f'Skipping {unloaded} emails whose bodies could not be loaded'}
+    
+    # PHASE 1 + 2: Category tagging and action item extraction run concurrently per batch.
+    # Categories are streamed as soon as they resolve (fast feedback), then action items.
+    # Persisted once at the end; events still stream per batch
+    with inbox_service.bulk():
+        for start in range(0, total, INGEST_BATCH_SIZE):
+            batch = current_emails[start:start + INGEST_BATCH_SIZE]
             
-            # Mark as ingested for mock/system emails only
-            source = (email.get("source") or "").lower()
-            if source not in ("draft", "gmail"):
-                email["source"] = "ingestion"
+            # Already-categorized emails, keyword rules and previously seen bodies
+            # are all resolved without the LLM
+            cache_keys = [category_cache_key(cat_prompt_template, email['body']) for email in batch]
+            categories = [
+                lookup_category(key, email['body'], rule_patterns) if needs_category(email) else email["category"]
+                for key, email in zip(cache_keys, batch)
+            ]
+            misses = [i for i, category in enumerate(categories) if category is None]
+            # Only emails without action items are sent to the LLM
+            pending = [i for i, email in enumerate(batch) if not email.get("action_items")]
             
-            # Save category immediately
-            inbox_service.upsert_email(email)
+            # Fire both request batches before awaiting either
+            cat_task = asyncio.create_task(llm_service.agenerate_batch([
+                build_categorization_prompt(cat_prompt_template, batch[i]['body'])
+                for i in misses
+            ]))
+            act_task = asyncio.create_task(llm_service.agenerate_batch([
+                build_action_items_prompt(action_prompt_template, batch[i]['body'])
+                for i in pending
+            ]))
             
-            # Stream the category update immediately (fast feedback)
-            yield f"data: {json.dumps({'type': 'category', 'email': email, 'processed': idx + 1, 'total': total})}\n\n"
-            await asyncio.sleep(0)
-        
-        # PHASE 2: Extract action items (slower, but category already visible)
-        for idx, email in enumerate(current_emails):
-            # Extract Actions only if not already present
-            if not email.get("action_items") or email.get("action_items") is None or len(email.get("action_items", [])) == 0:
-                prompt = f"{action_prompt_template}\n\nEmail Body:\n{email['body']}"
-                response = llm_service.generate(prompt)
-                
-                # Check if LLM returned an error
-                if response.startswith("Error calling Groq") or response.startswith("Error calling Ollama"):
-                    if not error_occurred:
-                        error_occurred = True
-                        yield f"data: {json.dumps({'type': 'error', 'message': response})}\n\n"
+            try:
+                for i, response in zip(misses, await cat_task):
+                    # Check if LLM returned an error
+                    if is_llm_error(response):
+                        yield {'type': 'error', 'message': response}
                         return
+                    categories[i] = response.strip()
+                    store_category(cache_keys[i], categories[i])
                 
-                try:
-                    start = response.find('{')
-                    end = response.rfind('}') + 1
-                    if start != -1 and end != -1:
-                        json_str = response[start:end]
-                        data = json.loads(json_str)
-                        email["action_items"] = data.get("tasks", [])
-                    else:
-                        email["action_items"] = []
-                except Exception as e:
-                    print(f"Action items parsing error: {e}")
-                    email["action_items"] = []
-                
-                # Save action items
-                inbox_service.upsert_email(email)
+                for offset, (email, category) in enumerate(zip(batch, categories)):
+                    email["category"] = category
+                    
+                    # Mark as ingested for mock/system emails only
+                    source = (email.get("source") or "").lower()
+                    if source not in ("draft", "gmail"):
+                        email["source"] = "ingestion"
+                    
+                    # Save category (written to disk when the batch loop ends)
+                    inbox_service.upsert_email(email)
+                    
+                    # Stream the category update (fast feedback, flushed per batch)
+                    yield {'type': 'category', 'email': email, 'processed': start + offset + 1, 'total': total}
                 
-                # Stream the action items update
-                yield f"data: {json.dumps({'type': 'action_items', 'email': email, 'processed': idx + 1, 'total': total})}\n\n"
-                await asyncio.sleep(0)
-        
-        # PHASE 3: Index all emails into RAG for semantic search
-        yield f"data: {json.dumps({'type': 'status', 'message': 'Indexing emails into RAG system...'})}\n\n"
-        indexed = 0
-        for email in current_emails:
-            if email.get("source") not in ["draft", "mock_draft", "gmail_draft"]:
-                rag_service.add_email_context(email, session_id="global")
-                indexed += 1
-        yield f"data: {json.dumps({'type': 'status', 'message': f'Indexed {indexed} emails for semantic search'})}\n\n"
-        
-        # Send completion message
-        yield f"data: {json.dumps({'type': 'complete', 'message': 'Ingestion complete'})}\n\n"
+                for i, response in zip(pending, await act_task):
+                    email = batch[i]
+                    # Check if LLM returned an error
+                    if is_llm_error(response):
+                        yield {'type': 'error', 'message': response}
+                        return
+                    
+                    try:
+                        match = JSON_OBJECT_RE.search(response)
+                        if match:
+                            data = orjson.loads(match.group(0))
+                            email["action_items"] = data.get("tasks", [])
+                        else:
+                            email["action_items"] = []
+                    except Exception as e:
+                        print(f"Action items parsing error: {e}")
+                        email["action_items"] = []
+                    
+                    # Save action items
+                    inbox_service.upsert_email(email)
+                    
+                    # Stream the action items update
+                    yield {'type': 'action_items', 'email': email, 'processed': start + i + 1, 'total': total}
+            finally:
+                # Don't leave the action item requests running after an error or disconnect
+                act_task.cancel()
+            await asyncio.sleep(0)
+
+    # PHASE 3: Index all emails into RAG for semantic search
+    yield {'type': 'status', 'message': 'Indexing emails into RAG system...'}
+    to_index = [e for e in current_emails if e.get("source") not in DRAFT_SOURCES]
+    # Emails already indexed with the same content are not re-embedded
+    indexed = len(await get_rag_service().add_email_contexts_async(to_index, session_id="global", skip_unchanged=True))
+    unchanged = len(to_index) - indexed
+    yield {'type': 'status', 'message': f'Indexed {indexed} emails for semantic search ({unchanged} already up to date)'}
     
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    # Send completion message
+    yield {'type': 'complete', 'message': 'Ingestion complete'}
+
+if EventSourceResponse is not None:
+    @app.post("/ingest", response_class=EventSourceResponse)
+    async def ingest_emails():
+        """Stream email processing updates in real-time using SSE"""
+        async for payload in ingest_events():
+            yield ServerSentEvent(data=payload)
+else:
+    @app.post("/ingest")
+    async def ingest_emails():
+        """Stream email processing updates in real-time using SSE"""
+        events = (f"data: {orjson.dumps(payload).decode()}\n\n" async for payload in ingest_events())
+        return StreamingResponse(events, media_type="text/event-stream")
 
 @app.post("/reset")
 def reset_inbox():
@@ -229,7 +414,7 @@ def reset_inbox():
     # Reset all emails except drafts: remove categories, set read to false, clear action items
     for email in emails:
         # Skip drafts - don't reset their category or other properties
-        if email.get("source") in ["draft", "mock_draft", "gmail_draft"]:
+        if email.get("source") in DRAFT_SOURCES:
             continue
             
         email["category"] = None
@@ -242,38 +427,28 @@ def reset_inbox():
 @app.post("/rag/index-emails")
 def index_all_emails():
     """Index all current emails into the RAG system for semantic search"""
-    emails = inbox_service.get_emails()
-    indexed_count = 0
-    
-    for email in emails:
-        # Skip drafts
-        if email.get("source") in ["draft", "mock_draft", "gmail_draft"]:
-            continue
-        
-        # Add each email to RAG with a global session (so it's searchable by all)
-        rag_service.add_email_context(email, session_id="global")
-        indexed_count += 1
+    # Skip drafts; index with a global session (so it's searchable by all)
+    to_index = inbox_service.get_excluding_sources(DRAFT_SOURCES)
+    # Gmail messages synced with headers only need their bodies before they're embedded
+    load_email_bodies(to_index)
+    # Emails Ollama couldn't embed aren't stored, so count what was actually added
+    indexed_count = len(get_rag_service().add_email_contexts(to_index, session_id="global"))
     
     return {
         "message": f"Indexed {indexed_count} emails into RAG system",
-        "total_emails": len(emails),
+        "total_emails": inbox_service.count_emails(),
         "indexed": indexed_count
     }
 
 @app.post("/oauth/load")
 def load_oauth_emails():
-    """Reload mock inbox file into the database and return it."""
+    """Return the mock emails currently in the inbox."""
     emails = inbox_service.load_mock_inbox()
     return {"message": f"Loaded {len(emails)} mock emails into the inbox", "emails": emails}
 
 @app.post("/emails/{email_id}/read")
 def mark_email_read(email_id: str):
-    emails = inbox_service.get_emails()
-    for email in emails:
-        if email["id"] == email_id:
-            email["read"] = True
-            break
-    inbox_service.save_emails(emails)
+    inbox_service.update_email(email_id, {"read": True})
     return {"message": "Email marked as read"}
 
 @app.get("/prompts")
@@ -298,77 +473,139 @@ def update_settings(settings: Settings):
         settings.groq_model,
         settings.ollama_model
     )
+    # Cached chat answers came from the previous provider/model
+    chat_cache.clear()
     return {"message": "Settings updated"}
 
-@app.post("/chat")
-def chat_agent(request: ChatRequest):
-    prompts = inbox_service.get_prompts()
-    emails = inbox_service.get_emails()
-    
+# Maximum cosine distance for a retrieved email to be included in the chat prompt
+# (lenient, so more emails make it in)
+RAG_DISTANCE_THRESHOLD = 0.6
+
+# Semantic chat cache -------------------------------------------------------
+
+# Minimum cosine similarity for a new question to reuse a cached answer
+CHAT_CACHE_SIMILARITY = 0.92
+
+# Recent (unit query embedding, context fingerprint, response) triples
+chat_cache: Deque[Tuple[np.ndarray, int, str]] = deque(maxlen=256)
+
+def chat_context_fingerprint(request: ChatRequest) -> int:
+    """Changes whenever the inbox, the selected email/thread or the retrieval depth changes."""
+    return hash((
+        inbox_service.get_version(),
+        request.email_id,
+        tuple(request.thread_email_ids or ()),
+        request.top_k
+    ))
+
+def lookup_chat_cache(query_embedding: np.ndarray, fingerprint: int) -> Optional[str]:
+    for cached_embedding, cached_fingerprint, response in reversed(chat_cache):
+        if cached_fingerprint == fingerprint and np.dot(query_embedding, cached_embedding) >= CHAT_CACHE_SIMILARITY:
+            return response
+    return None
+
+async def prepare_chat(request: ChatRequest) -> Tuple[str, Optional[str], Optional[str], Optional[Tuple[np.ndarray, int]]]:
+    """
+    Build the chat prompt for a request.
+    Returns (session_id, prompt, cached_response, cache_key); prompt is None when a
+    cached answer can be reused, and cache_key is None when the answer can't be cached.
+    """
     # Generate or use provided session ID
     session_id = request.session_id or str(uuid.uuid4())
     
+    # Reuse the answer to a near-identical question asked against the same inbox
+    try:
+        query_embedding = await asyncio.to_thread(get_rag_service().embed_query, request.message)
+    except EmbeddingUnavailable:
+        # Without an embedding the answer can't be matched against (or cached for) later questions
+        query_embedding = np.zeros(0, dtype=np.float32)
+    query_norm = np.linalg.norm(query_embedding)
+    fingerprint = chat_context_fingerprint(request)
+    if query_norm:
+        query_embedding = query_embedding / query_norm
+        cached_response = lookup_chat_cache(query_embedding, fingerprint)
+        if cached_response is not None:
+            return session_id, None, cached_response, None
+    
     # Retrieve relevant context from RAG using semantic search
     # Search across ALL emails and conversations, not just this session
-    rag_contexts = rag_service.query_context(
+    # Embedding + vector search are blocking, so they run off the event loop
+    _, distances, metadatas, documents = await asyncio.to_thread(
+        get_rag_service().query_context,
         query=request.message,
         top_k=request.top_k or 10,  # Increased to find more email matches
         session_id=None,  # Search globally, not just this session
-        email_id=None
+        email_id=None,
+        return_raw=True,
+        # Cosine distance ignores scale, so the normalized vector works as is
+        query_embedding=query_embedding if query_norm else None
     )
     
     # Build context from RAG results - only emails and action items
+    # Parts are collected in a list and joined once to avoid quadratic string building
+    # Only include if distance/similarity is good (lower distance = more similar).
+    # Chroma already returns results nearest first, so the kept indices stay ranked
+    keep = np.flatnonzero(distances < RAG_DISTANCE_THRESHOLD)
     rag_context = ""
-    if rag_contexts:
-        rag_context = "\n=== Relevant Emails from Your Inbox ===\n"
-        for idx, ctx in enumerate(rag_contexts, 1):
-            # Only include if distance/similarity is good (lower distance = more similar)
-            if ctx.get('distance', 1.0) < 1.2:  # More lenient threshold to include emails
-                doc_text = ctx['document']
-                
-                # Format email context with full details including action items
-                rag_context += f"\n[Email {idx}]\n"
-                rag_context += f"Category/Tag: {ctx['metadata'].get('email_category', 'N/A')}\n"
-                rag_context += f"Subject: {ctx['metadata'].get('email_subject', 'N/A')}\n"
-                rag_context += f"From: {ctx['metadata'].get('email_sender', 'N/A')}\n"
-                
-                # Include the full document text (contains body + action items with delimiters)
-                # This ensures action items are properly shown
-                if '=== ACTION ITEMS ===' in doc_text:
-                    # Document has structured action items, include them prominently
-                    rag_context += f"\n{doc_text}\n"
-                else:
-                    # Just show first part of document
-                    rag_context += f"\nContent: {doc_text[:600]}...\n"
-        rag_context += "\n=== End Relevant Emails ===\n\n"
+    if keep.size:
+        parts = ["\n=== Relevant Emails from Your Inbox ===\n"]
+        for idx, i in enumerate(keep, 1):
+            doc_text = documents[i]
+            metadata = metadatas[i]
+            
+            # Format email context with full details including action items
+            parts.append(
+                f"\n[Email {idx}]\n"
+                f"Category/Tag: {metadata.get('email_category', 'N/A')}\n"
+                f"Subject: {metadata.get('email_subject', 'N/A')}\n"
+                f"From: {metadata.get('email_sender', 'N/A')}\n"
+            )
+            
+            # Include the full document text (contains body + action items with delimiters)
+            # This ensures action items are properly shown
+            if '=== ACTION ITEMS ===' in doc_text:
+                # Document has structured action items, include them prominently
+                parts.append(f"\n{doc_text}\n")
+            else:
+                # Just show first part of document
+                parts.append(f"\nContent: {doc_text[:600]}...\n")
+        parts.append("\n=== End Relevant Emails ===\n\n")
+        rag_context = "".join(parts)
     
     context = ""
     email_context = None
     
     # Handle thread context if provided
     if request.thread_email_ids and len(request.thread_email_ids) > 1:
-        thread_emails = [e for e in emails if e["id"] in request.thread_email_ids]
+        thread_emails = [
+            e for e in (inbox_service.get_email(i) for i in request.thread_email_ids) if e
+        ]
         if thread_emails:
+            await asyncio.to_thread(load_email_bodies, thread_emails)
             # Sort by timestamp
             thread_emails.sort(key=lambda x: x.get("timestamp", ""))
-            context = f"Email Thread ({len(thread_emails)} messages):\n\n"
+            parts = [f"Email Thread ({len(thread_emails)} messages):\n\n"]
             for idx, email in enumerate(thread_emails, 1):
-                context += f"Message {idx}:\n"
-                context += f"From: {email['sender']}\n"
-                context += f"Subject: {email['subject']}\n"
-                context += f"Date: {email.get('timestamp', 'Unknown')}\n"
-                context += f"Body: {email['body']}\n\n"
-            context += "---\n\n"
+                parts.append(
+                    f"Message {idx}:\n"
+                    f"From: {email['sender']}\n"
+                    f"Subject: {email['subject']}\n"
+                    f"Date: {email.get('timestamp', 'Unknown')}\n"
+                    f"Body: {email['body']}\n\n"
+                )
+            parts.append("---\n\n")
+            context = "".join(parts)
             # Use first email as primary context for RAG storage
             email_context = thread_emails[0] if thread_emails else None
     elif request.email_id:
         # Single email context
-        email = next((e for e in emails if e["id"] == request.email_id), None)
+        email = inbox_service.get_email(request.email_id)
         if email:
+            await asyncio.to_thread(load_email_bodies, [email])
             context = f"Selected Email:\nFrom: {email['sender']}\nSubject: {email['subject']}\nBody: {email['body']}\n\n"
             email_context = email
             # Add this email to RAG context if not already present
-            rag_service.add_email_context(email, session_id=session_id)
+            await asyncio.to_thread(get_rag_service().add_email_context, email, session_id=session_id)
     
     # If no specific email, maybe provide a summary of the inbox (simplified for now)
     if not context:
@@ -395,29 +632,80 @@ Answer the question directly and concisely. When referencing emails, include:
 - Action items with deadlines if present
 
 Answer:"""
-    response = llm_service.generate(prompt)
-    
+    cache_key = (query_embedding, fingerprint) if query_norm else None
+    return session_id, prompt, None, cache_key
+
+def store_chat_response(cache_key: Optional[Tuple[np.ndarray, int]], response: str):
     # Note: We don't store chat turns - RAG only contains emails and action items
+    if cache_key is not None and not response.startswith("Error"):
+        chat_cache.append((*cache_key, response))
+
+@app.post("/chat")
+async def chat_agent(request: ChatRequest):
+    session_id, prompt, cached_response, cache_key = await prepare_chat(request)
+    if prompt is None:
+        return {"response": cached_response, "session_id": session_id}
+    
+    response = await llm_service.agenerate(prompt)
+    store_chat_response(cache_key, response)
     
     return {"response": response, "session_id": session_id}
 
+async def chat_stream_events(request: ChatRequest):
+    """
+    Yield the chat answer as SSE payloads: the session, then tokens, then the full
+    text, or an error event if the provider fails partway
+    """
+    session_id, prompt, cached_response, cache_key = await prepare_chat(request)
+    yield {'type': 'session', 'session_id': session_id}
+    
+    if prompt is None:
+        yield {'type': 'token', 'content': cached_response}
+        yield {'type': 'done', 'response': cached_response}
+        return
+    
+    chunks = []
+    try:
+        async for chunk in llm_service.generate_stream(prompt):
+            if chunk:
+                chunks.append(chunk)
+                yield {'type': 'token', 'content': chunk}
+    except LLMStreamError as e:
+        # A failed stream is reported on its own and its partial answer is never cached
+        yield {'type': 'error', 'message': str(e)}
+        return
+    response = "".join(chunks)
+    store_chat_response(cache_key, response)
+    yield {'type': 'done', 'response': response}
+
+if EventSourceResponse is not None:
+    @app.post("/chat/stream", response_class=EventSourceResponse)
+    async def chat_stream(request: ChatRequest):
+        """Stream the chat answer token by token using SSE"""
+        async for payload in chat_stream_events(request):
+            yield ServerSentEvent(data=payload)
+else:
+    @app.post("/chat/stream")
+    async def chat_stream(request: ChatRequest):
+        """Stream the chat answer token by token using SSE"""
+        events = (f"data: {orjson.dumps(payload).decode()}\n\n" async for payload in chat_stream_events(request))
+        return StreamingResponse(events, media_type="text/event-stream")
+
 @app.post("/draft")
 def generate_draft(request: DraftRequest):
     prompts = inbox_service.get_prompts()
-    emails = inbox_service.get_emails()
-    email = next((e for e in emails if e["id"] == request.email_id), None)
+    email = inbox_service.get_email(request.email_id)
     
     if not email:
         raise HTTPException(status_code=404, detail="Email not found")
+    load_email_bodies([email])
         
     auto_reply_prompt = prompts["auto_reply"]["template"]
     
-    prompt = f"{auto_reply_prompt}\n\nOriginal Email:\nFrom: {email['sender']}\nSubject: {email['subject']}\nBody: {email['body']}\n\nDraft a reply:"
-    
-    if request.instructions:
-        prompt += f"\nAdditional Instructions: {request.instructions}"
+    prompt = build_auto_reply_prompt(auto_reply_prompt, email, request.instructions)
         
-    draft_body = llm_service.generate(prompt)
+    # Generating again should give a fresh draft, not the remembered one
+    draft_body = llm_service.generate(prompt, use_cache=False)
     
     return {
         "subject": f"Re: {email['subject']}",
@@ -448,44 +736,39 @@ def save_draft(draft: SaveDraftRequest):
         "source": draft.source
     }
     
-    emails = inbox_service.get_emails()
-    emails.append(new_draft)
-    inbox_service.save_emails(emails)
+    inbox_service.upsert_email(new_draft)
     
     return {"message": "Draft saved successfully", "draft": new_draft}
 
 @app.delete("/drafts/{draft_id}")
 def delete_draft(draft_id: str):
     """Delete a draft email"""
-    emails = inbox_service.get_emails()
+    email = inbox_service.get_email(draft_id)
     
-    for i, email in enumerate(emails):
-        if email["id"] == draft_id and email.get("category", "").lower() == "draft":
-            emails.pop(i)
-            inbox_service.save_emails(emails)
-            return {"message": "Draft deleted successfully"}
+    if email and (email.get("category") or "").lower() == "draft":
+        inbox_service.delete_email(draft_id)
+        return {"message": "Draft deleted successfully"}
     
     raise HTTPException(status_code=404, detail="Draft not found")
 
 @app.delete("/emails/{email_id}/tasks/{task_index}")
 def delete_action_item(email_id: str, task_index: int):
     """Delete an action item from an email"""
-    emails = inbox_service.get_emails()
+    email = inbox_service.get_email(email_id)
     
-    for email in emails:
-        if email["id"] == email_id:
-            if "action_items" in email and email["action_items"]:
-                if 0 <= task_index < len(email["action_items"]):
-                    # Remove the action item
-                    email["action_items"].pop(task_index)
-                    inbox_service.save_emails(emails)
-                    return {"message": "Action item deleted successfully"}
-                else:
-                    raise HTTPException(status_code=404, detail="Task index out of range")
-            else:
-                raise HTTPException(status_code=404, detail="No action items found")
+    if not email:
+        raise HTTPException(status_code=404, detail="Email not found")
+    
+    action_items = email.get("action_items")
+    if not action_items:
+        raise HTTPException(status_code=404, detail="No action items found")
+    if not 0 <= task_index < len(action_items):
+        raise HTTPException(status_code=404, detail="Task index out of range")
     
-    raise HTTPException(status_code=404, detail="Email not found")
+    # Remove the action item
+    remaining = action_items[:task_index] + action_items[task_index + 1:]
+    inbox_service.update_email(email_id, {"action_items": remaining})
+    return {"message": "Action item deleted successfully"}
 
 @app.post("/emails/clear")
 def clear_all_indexes():
@@ -497,18 +780,21 @@ def clear_all_indexes():
 @app.post("/rag/reset")
 def reset_rag():
     """Reset all RAG indexed emails and action items (use with caution)"""
-    rag_service.reset()
+    get_rag_service().reset()
     return {"message": "All RAG indexed content has been reset"}
 
 @app.get("/rag/stats")
 def get_rag_stats():
     """Get RAG system statistics"""
+    rag = get_rag_service()
     try:
-        count = rag_service.collection.count()
+        # Count documents still waiting in the background write queue too
+        rag.flush()
+        count = rag.collection.count()
         return {
             "indexed_documents": count,
-            "collection_name": rag_service.collection.name,
-            "embedding_model": rag_service.embedding_model
+            "collection_name": rag.collection.name,
+            "embedding_model": rag.embedding_model
         }
     except Exception as e:
         return {"error": str(e)}
@@ -34,6 +34,9 @@ class ChatRequest(BaseModel):
     session_id: Optional[str] = None  # For RAG conversation tracking
     top_k: Optional[int] = 5  # Number of context chunks to retrieve
 
+class EmailBodiesRequest(BaseModel):
+    ids: List[str]
+
 class DraftRequest(BaseModel):
     email_id: str
     instructions: Optional[str] = None
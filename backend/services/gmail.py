@@ -2,22 +2,57 @@ import base64
 import os
 import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from email.message import EmailMessage
 from email.utils import getaddresses
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
+import httplib2
 import requests
 from fastapi import HTTPException
+from google_auth_httplib2 import AuthorizedHttp
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google.auth.exceptions import RefreshError
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from googleapiclient.errors import BatchError, HttpError
 from google_auth_oauthlib.flow import Flow
 
 from services.inbox import inbox_service
 
+# Placeholder categories assigned from Gmail system labels at sync time
+LABEL_CATEGORIES = frozenset({"Inbox", "Sent", "Draft", "Spam", "Trash"})
+# System labels checked in priority order; anything else is "Inbox"
+CATEGORY_PRIORITY = (("SENT", "Sent"), ("DRAFT", "Draft"), ("SPAM", "Spam"), ("TRASH", "Trash"))
+
+# Gmail accepts at most 100 calls per batch request
+BATCH_SIZE = 100
+# Concurrent message fetches when a batch request can't be used
+FETCH_WORKERS = 10
+# Seconds before a Gmail API call is abandoned
+HTTP_TIMEOUT = 30
+# OAuth states expire after this many seconds, and at most this many are kept
+PENDING_STATE_TTL = 600
+MAX_PENDING_STATES = 1024
+
+# Headers requested when syncing; bodies are fetched separately when needed
+METADATA_HEADERS = ["From", "To", "Cc", "Bcc", "Subject", "Message-ID", "In-Reply-To", "References", "Date"]
+# Partial-response projections: only the fields records are built from are sent back
+MESSAGE_FIELDS = "id,threadId,historyId,labelIds,internalDate,snippet"
+METADATA_FIELDS = f"{MESSAGE_FIELDS},payload/headers"
+FULL_FIELDS = f"{MESSAGE_FIELDS},payload(mimeType,filename,headers,body/data,parts)"
+# Lowercased names of the headers records are built from; the rest are never parsed
+WANTED_HEADERS = frozenset(name.lower() for name in METADATA_HEADERS)
+
+
+@lru_cache(maxsize=4096)
+def _parse_addresses(header_value: str) -> Tuple[str, ...]:
+    """Parse an address header once; the same recipient lists recur across a thread."""
+    return tuple(addr for _, addr in getaddresses([header_value]) if addr)
+
 
 class GmailService:
     SCOPES = [
@@ -39,29 +74,42 @@ class GmailService:
             or os.getenv("GMAIL_REDIRECT_URI", "http://localhost:8000/gmail/oauth/callback")
         )
         self._creds: Optional[Credentials] = None
-        self._pending_states: Dict[str, float] = {}
+        # Serializes loading and refreshing so concurrent requests don't refresh twice
+        self._creds_lock = threading.Lock()
+        # Built API clients and their keep-alive connections, one per worker thread
+        # since httplib2 isn't thread-safe
+        self._local = threading.local()
+        # Long-lived so fallback fetch workers keep their connections between syncs
+        self._fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+        # OAuth state -> creation time, oldest first so expired entries are pruned from the front
+        self._pending_states: "OrderedDict[str, float]" = OrderedDict()
+        self._pending_lock = threading.Lock()
 
     # Credential helpers -------------------------------------------------
 
     def _credentials(self) -> Optional[Credentials]:
-        if self._creds and self._creds.valid:
-            return self._creds
-        if os.path.exists(self.token_file):
-            self._creds = Credentials.from_authorized_user_file(self.token_file, self.SCOPES)
-        if self._creds and self._creds.expired and self._creds.refresh_token:
-            try:
-                self._creds.refresh(Request())
-                self._save_credentials()
-            except RefreshError:
-                # Token expired or revoked — clear stored token and credentials
+        # Fast path: cached credentials that aren't close to expiry
+        creds = self._creds
+        if creds and creds.valid:
+            return creds
+        with self._creds_lock:
+            # The token file is only read when nothing is cached yet
+            if self._creds is None and os.path.exists(self.token_file):
+                self._creds = Credentials.from_authorized_user_file(self.token_file, self.SCOPES)
+            if self._creds and not self._creds.valid and self._creds.refresh_token:
                 try:
-                    if os.path.exists(self.token_file):
-                        os.remove(self.token_file)
-                except Exception:
-                    pass
-                self._creds = None
-                return None
-        return self._creds
+                    self._creds.refresh(Request())
+                    self._save_credentials()
+                except RefreshError:
+                    # Token expired or revoked — clear stored token and credentials
+                    try:
+                        if os.path.exists(self.token_file):
+                            os.remove(self.token_file)
+                    except Exception:
+                        pass
+                    self._creds = None
+                    return None
+            return self._creds
 
     def _save_credentials(self):
         if self._creds:
@@ -82,11 +130,27 @@ class GmailService:
         auth_url, state = flow.authorization_url(
             access_type="offline", include_granted_scopes="true", prompt="consent"
         )
-        self._pending_states[state] = time.time()
+        now = time.time()
+        with self._pending_lock:
+            self._prune_pending_states(now)
+            self._pending_states[state] = now
+            if len(self._pending_states) > MAX_PENDING_STATES:
+                self._pending_states.popitem(last=False)
         return auth_url
 
+    def _prune_pending_states(self, now: float):
+        """Drop OAuth states that were never completed within the TTL."""
+        while self._pending_states:
+            state, created = next(iter(self._pending_states.items()))
+            if now - created < PENDING_STATE_TTL:
+                break
+            self._pending_states.popitem(last=False)
+
     def finish_auth(self, state: str, code: str):
-        if state not in self._pending_states:
+        with self._pending_lock:
+            self._prune_pending_states(time.time())
+            known = state in self._pending_states
+        if not known:
             raise HTTPException(status_code=400, detail="Unknown OAuth state")
 
         flow = Flow.from_client_secrets_file(
@@ -102,19 +166,32 @@ class GmailService:
         if profile_email:
             inbox_service.set_sync_state("gmail_profile_email", profile_email)
         inbox_service.set_sync_state("gmail_last_auth", datetime.now(timezone.utc).isoformat())
-        self._pending_states.pop(state, None)
+        with self._pending_lock:
+            self._pending_states.pop(state, None)
 
     # Gmail client helpers ----------------------------------------------
 
+    def _authorized_http(self, creds: Credentials) -> AuthorizedHttp:
+        """This thread's authorized connection, reused until the credentials object is replaced
+        (new login, logout or a failed refresh); in-place token refreshes keep it valid."""
+        if getattr(self._local, "http", None) is None or self._local.creds is not creds:
+            self._local.http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+            self._local.service = None
+            self._local.creds = creds
+        return self._local.http
+
     def _service(self):
         creds = self._credentials()
         if not creds:
             raise HTTPException(status_code=401, detail="Connect Gmail first")
-        return build("gmail", "v1", credentials=creds, cache_discovery=False)
+        http = self._authorized_http(creds)
+        if self._local.service is None:
+            self._local.service = build("gmail", "v1", http=http, cache_discovery=False)
+        return self._local.service
 
     def _lookup_profile_email(self) -> Optional[str]:
         try:
-            profile = self._service().users().getProfile(userId="me").execute()
+            profile = self._service().users().getProfile(userId="me", fields="emailAddress").execute()
             return profile.get("emailAddress")
         except HttpError:
             return None
@@ -141,39 +218,51 @@ class GmailService:
     # Message parsing ---------------------------------------------------
 
     def _parse_headers(self, payload: Dict[str, Any]) -> Dict[str, str]:
-        headers = payload.get("headers", [])
-        return {h.get("name", "").lower(): h.get("value", "") for h in headers}
+        parsed = {}
+        for header in payload.get("headers", []):
+            name = header.get("name", "").lower()
+            if name in WANTED_HEADERS:
+                parsed[name] = header.get("value", "")
+        return parsed
 
     def _parse_recipients(self, header_value: Optional[str]) -> List[str]:
         if not header_value:
             return []
-        addresses = getaddresses([header_value])
-        return [addr for _, addr in addresses if addr]
+        return list(_parse_addresses(header_value))
+
+    def _decode_data(self, data: str) -> str:
+        try:
+            return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode("utf-8", errors="ignore")
+        except Exception:
+            return ""
 
     def _decode_body(self, payload: Dict[str, Any]) -> str:
-        data = payload.get("body", {}).get("data")
-        if data:
-            try:
-                return base64.urlsafe_b64decode(data + "==").decode("utf-8", errors="ignore")
-            except Exception:
-                return ""
-        parts = payload.get("parts", [])
-        for part in parts:
-            if part.get("mimeType") == "text/plain":
-                return self._decode_body(part)
-        if parts:
-            return self._decode_body(parts[0])
-        return ""
-
-    def _to_email_record(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        # Breadth-first walk: the first text/plain part wins, otherwise the first other
+        # text part (e.g. HTML-only mail). Attachments are never decoded
+        fallback = None
+        queue = deque([payload])
+        while queue:
+            part = queue.popleft()
+            data = part.get("body", {}).get("data")
+            if data and not part.get("filename"):
+                mime_type = part.get("mimeType", "")
+                if mime_type == "text/plain":
+                    return self._decode_data(data)
+                if fallback is None and (not mime_type or mime_type.startswith("text/")):
+                    fallback = data
+            queue.extend(part.get("parts", []))
+        return self._decode_data(fallback) if fallback else ""
+
+    def _to_email_record(self, message: Dict[str, Any], full: bool = True) -> Dict[str, Any]:
         payload = message.get("payload", {})
         headers = self._parse_headers(payload)
-        internal_date = message.get("internalDate")
+        # Gmail sends internalDate as a string of epoch milliseconds
+        internal_date = int(message["internalDate"]) if message.get("internalDate") else None
         timestamp = None
         if internal_date:
-            timestamp = datetime.utcfromtimestamp(int(internal_date) / 1000).isoformat()
+            timestamp = datetime.fromtimestamp(internal_date // 1000, tz=timezone.utc).isoformat()
         label_ids = message.get("labelIds", [])
-        body = self._decode_body(payload)
+        body = self._decode_body(payload) if full else ""
         return {
             "id": message.get("id"),
             "thread_id": message.get("threadId"),
@@ -186,6 +275,7 @@ class GmailService:
             "subject": headers.get("subject"),
             "snippet": message.get("snippet"),
             "body": body,
+            "body_loaded": full,
             "timestamp": timestamp,
             "internal_date": internal_date,
             "read": "UNREAD" not in label_ids,
@@ -196,14 +286,10 @@ class GmailService:
         }
 
     def _resolve_category(self, label_ids: List[str]) -> str:
-        if "SENT" in label_ids:
-            return "Sent"
-        if "DRAFT" in label_ids:
-            return "Draft"
-        if "SPAM" in label_ids:
-            return "Spam"
-        if "TRASH" in label_ids:
-            return "Trash"
+        labels = set(label_ids)
+        for label, category in CATEGORY_PRIORITY:
+            if label in labels:
+                return category
         return "Inbox"
 
     # Sync operations ---------------------------------------------------
@@ -220,13 +306,14 @@ class GmailService:
         try:
             if full_sync or not start_history_id:
                 message_ids = self._list_recent_message_ids(service)
-                for msg_id in message_ids:
-                    record, history_id = self._fetch_message(service, msg_id)
+                records = []
+                for record, history_id in self._fetch_messages(service, message_ids):
                     if record:
-                        inbox_service.upsert_email(record)
-                        synced += 1
+                        records.append(record)
                         if history_id and (not newest_history or int(history_id) > int(newest_history or 0)):
                             newest_history = history_id
+                inbox_service.upsert_many(records)
+                synced = len(records)
             else:
                 synced, newest_history = self._sync_via_history(service, start_history_id)
         except HttpError as exc:
@@ -261,6 +348,7 @@ class GmailService:
                     maxResults= min(20 - len(ids), 200),
                     q="newer_than:60d",
                     pageToken=page_token,
+                    fields="messages/id,nextPageToken",
                 )
                 .execute()
             )
@@ -272,17 +360,102 @@ class GmailService:
                 break
         return ids[:20]
 
-    def _fetch_message(self, service, message_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
-        message = (
-            service.users().messages().get(userId="me", id=message_id, format="full").execute()
+    def _message_request(self, service, message_id: str, full: bool = False):
+        if full:
+            return service.users().messages().get(
+                userId="me", id=message_id, format="full", fields=FULL_FIELDS
+            )
+        return service.users().messages().get(
+            userId="me",
+            id=message_id,
+            format="metadata",
+            metadataHeaders=METADATA_HEADERS,
+            fields=METADATA_FIELDS,
         )
-        record = self._to_email_record(message)
+
+    def _fetch_message(
+        self, service, message_id: str, full: bool = False
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        message = self._message_request(service, message_id, full).execute()
+        record = self._to_email_record(message, full)
         return record, message.get("historyId")
 
+    def _fetch_messages(
+        self, service, message_ids: List[str], full: bool = False
+    ) -> List[Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+        """Fetch messages with batched requests, up to 100 per HTTP round trip."""
+        # A batch rejects repeated request ids, and history can list a message twice
+        message_ids = list(dict.fromkeys(message_ids))
+        results: Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]] = {}
+        errors: List[HttpError] = []
+
+        def on_message(request_id, response, exception):
+            if exception is not None:
+                # Messages deleted since they were listed are skipped
+                if not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                    errors.append(exception)
+                return
+            record = self._to_email_record(response, full)
+            if not full:
+                # Keep a body that was already downloaded for this message
+                existing = inbox_service.get_email(request_id)
+                if existing and existing.get("body_loaded", True) and existing.get("body"):
+                    record["body"] = existing["body"]
+                    record["body_loaded"] = True
+            results[request_id] = (record, response.get("historyId"))
+
+        for start in range(0, len(message_ids), BATCH_SIZE):
+            chunk = message_ids[start:start + BATCH_SIZE]
+            try:
+                batch = service.new_batch_http_request(callback=on_message)
+                for msg_id in chunk:
+                    batch.add(self._message_request(service, msg_id, full), request_id=msg_id)
+                batch.execute()
+            except (BatchError, HttpError) as exc:
+                print(f"Gmail batch request failed, fetching messages individually: {exc}")
+                self._fetch_messages_parallel(service, chunk, full, on_message)
+            if errors:
+                raise errors[0]
+        return [results[msg_id] for msg_id in message_ids if msg_id in results]
+
+    def _fetch_messages_parallel(self, service, message_ids: List[str], full: bool, callback):
+        """Fetch messages concurrently, reporting each one through a batch-style callback."""
+        creds = self._credentials()
+
+        def fetch(msg_id: str):
+            # httplib2 connections are not thread-safe, so each worker uses its own
+            http = self._authorized_http(creds)
+            try:
+                return msg_id, self._message_request(service, msg_id, full).execute(http=http), None
+            except HttpError as exc:
+                return msg_id, None, exc
+
+        for msg_id, response, exception in self._fetch_pool.map(fetch, message_ids):
+            callback(msg_id, response, exception)
+
+    def fetch_full_bodies(self, message_ids: List[str]) -> List[Dict[str, Any]]:
+        """Download the bodies of messages synced with headers only and store them."""
+        if not message_ids:
+            return []
+        service = self._service()
+        updated = []
+        with inbox_service.bulk():
+            for record, _ in self._fetch_messages(service, message_ids, full=True):
+                email = inbox_service.update_email(
+                    record["id"], {"body": record["body"], "body_loaded": True}
+                )
+                if email:
+                    updated.append(email)
+        return updated
+
+    def fetch_full_body(self, message_id: str) -> Optional[Dict[str, Any]]:
+        updated = self.fetch_full_bodies([message_id])
+        return updated[0] if updated else None
+
     def _sync_via_history(self, service, start_history_id: str) -> Tuple[int, Optional[str]]:
-        synced = 0
         newest_history = start_history_id
         page_token = None
+        message_ids: List[str] = []
         while True:
             history = (
                 service.users()
@@ -292,24 +465,27 @@ class GmailService:
                     startHistoryId=start_history_id,
                     historyTypes=["messageAdded"],
                     pageToken=page_token,
+                    fields="history/messagesAdded/message/id,nextPageToken,historyId",
                 )
                 .execute()
             )
             for item in history.get("history", []):
                 for added in item.get("messagesAdded", []):
-                    msg_id = added["message"]["id"]
-                    record, history_id = self._fetch_message(service, msg_id)
-                    if record:
-                        inbox_service.upsert_email(record)
-                        synced += 1
-                        if history_id and int(history_id) > int(newest_history or 0):
-                            newest_history = history_id
+                    message_ids.append(added["message"]["id"])
             page_token = history.get("nextPageToken")
             if not page_token:
-                if history.get("historyId"):
-                    newest_history = history["historyId"]
                 break
-        return synced, newest_history
+
+        records = []
+        for record, history_id in self._fetch_messages(service, message_ids):
+            if record:
+                records.append(record)
+                if history_id and int(history_id) > int(newest_history or 0):
+                    newest_history = history_id
+        inbox_service.upsert_many(records)
+        if history.get("historyId"):
+            newest_history = history["historyId"]
+        return len(records), newest_history
 
     def logout(self):
         creds = self._credentials()
@@ -327,10 +503,7 @@ class GmailService:
             os.remove(self.token_file)
         self._creds = None
         # Clear Gmail emails by clearing gmail_inbox.json
-        import json
-        from services.inbox import GMAIL_INBOX_FILE
-        with open(GMAIL_INBOX_FILE, 'w') as f:
-            json.dump([], f)
+        inbox_service.clear_gmail_emails()
         for key in [
             "gmail_profile_email",
             "gmail_last_sync",
@@ -379,11 +552,17 @@ class GmailService:
         if thread_id:
             send_body["threadId"] = thread_id
 
-        sent = service.users().messages().send(userId="me", body=send_body).execute()
-        record, history_id = self._fetch_message(service, sent["id"])
+        sent = service.users().messages().send(userId="me", body=send_body, fields="id,threadId").execute()
+        return {"message_id": sent.get("id"), "thread_id": sent.get("threadId")}
+
+    def refresh_sent_message(self, message_id: str):
+        """Store a just-sent message locally; run after the send response has gone out."""
+        try:
+            record, history_id = self._fetch_message(self._service(), message_id, full=True)
+        except (HTTPException, HttpError) as exc:
+            print(f"Error fetching sent message {message_id}: {exc}")
+            return
         if record:
             inbox_service.upsert_email(record)
             if history_id:
                 inbox_service.set_sync_state("gmail_history_id", str(history_id))
-
-        return {"message_id": sent.get("id"), "thread_id": sent.get("threadId")}
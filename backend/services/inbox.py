@@ -1,6 +1,15 @@
+import fcntl
 import json
 import os
-from typing import Dict, List, Optional
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional
+
+import orjson
+
+from services import db
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 INBOX_FILE = os.path.join(DATA_DIR, "inbox.json")
@@ -10,10 +19,52 @@ GMAIL_DRAFTS_FILE = os.path.join(DATA_DIR, "gmail_drafts.json")
 PROMPTS_FILE = os.path.join(DATA_DIR, "prompts.json")
 SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
 SYNC_STATE_FILE = os.path.join(DATA_DIR, "sync_state.json")
+DB_FILE = os.path.join(DATA_DIR, "inbox.db")
+
+# JSON files emails were stored in before the database, imported once on first start
+EMAIL_FILES = [INBOX_FILE, GMAIL_INBOX_FILE, DRAFTS_FILE, GMAIL_DRAFTS_FILE]
+# Bumped in the database once the JSON files have been imported
+SCHEMA_VERSION = 1
+
+# Email ids touched inside the current bulk() block. Each request (task or worker thread)
+# has its own context, so only the caller that opened the block has its writes deferred
+_bulk_pending: ContextVar[Optional[set]] = ContextVar("inbox_bulk_pending", default=None)
+
+def _write_json_atomic(path: str, data):
+    """Write JSON to a temp file and swap it in, so readers never see a partial file.
+    A lock file serializes writers across processes (e.g. several uvicorn workers)."""
+    with open(path + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+
+# Mock/system emails are everything that isn't from Gmail or a draft
+NON_MOCK_SOURCES = ("gmail", "gmail_draft", "draft", "mock_draft")
 
 class InboxService:
     def __init__(self):
         self._ensure_files()
+        self._db = db.connect(DB_FILE)
+        # Guards the in-memory store and database writes against concurrent requests
+        self._lock = threading.RLock()
+        # All emails keyed by id, loaded once and kept in memory
+        self._emails: "OrderedDict[str, Dict]" = OrderedDict()
+        # Secondary index: source -> {id: email}, plus the source each id was indexed under
+        self._by_source: Dict[str, Dict[str, Dict]] = defaultdict(dict)
+        self._indexed_source: Dict[str, str] = {}
+        # Emails ordered newest first; rebuilt lazily after any mutation
+        self._sorted_cache: Optional[List[Dict]] = None
+        # Bumped on every change to the in-memory emails, so callers can cheaply detect them
+        self._version = 0
+        # Parsed prompts/settings keyed by path, with the mtime they were read at
+        self._file_cache: Dict[str, tuple] = {}
+        # Sync state is read on every status poll, so it's kept in memory and written through
+        with open(SYNC_STATE_FILE, 'r') as f:
+            self._sync_state: Dict[str, str] = json.load(f)
+        self._sync_state_lock = threading.Lock()
+        self._load_emails()
 
     def _ensure_files(self):
         """Ensure all JSON files exist."""
@@ -21,157 +72,266 @@ class InboxService:
         if not os.path.exists(INBOX_FILE):
             with open(INBOX_FILE, 'w') as f:
                 json.dump([], f)
-        if not os.path.exists(GMAIL_INBOX_FILE):
-            with open(GMAIL_INBOX_FILE, 'w') as f:
-                json.dump([], f)
-        if not os.path.exists(DRAFTS_FILE):
-            with open(DRAFTS_FILE, 'w') as f:
-                json.dump([], f)
-        if not os.path.exists(GMAIL_DRAFTS_FILE):
-            with open(GMAIL_DRAFTS_FILE, 'w') as f:
-                json.dump([], f)
         if not os.path.exists(SYNC_STATE_FILE):
             with open(SYNC_STATE_FILE, 'w') as f:
                 json.dump({}, f)
 
+    def _load_emails(self):
+        """Load every email from the database into the in-memory store."""
+        self._emails.clear()
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self._import_email_files()
+        for (doc,) in self._db.execute("SELECT doc FROM emails ORDER BY rowid"):
+            email = orjson.loads(doc)
+            self._emails[email.get("id")] = email
+        self._reindex()
+        self._invalidate_cache()
+
+    def _import_email_files(self):
+        """Copy emails from the old JSON files into the database."""
+        emails = OrderedDict()
+        for path in EMAIL_FILES:
+            for email in self._read_email_file(path):
+                emails[email.get("id")] = email
+        with self._lock, db.transaction(self._db):
+            self._db.executemany(
+                "INSERT OR REPLACE INTO emails (id, source, internal_date, doc) VALUES (?, ?, ?, ?)",
+                [self._row(email) for email in emails.values()]
+            )
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _index(self, email: Dict):
+        """Record an email under its current source, moving it if the source changed."""
+        email_id = email.get("id")
+        source = email.get("source")
+        previous = self._indexed_source.get(email_id)
+        if previous is not None and previous != source:
+            self._by_source[previous].pop(email_id, None)
+        self._by_source[source][email_id] = email
+        self._indexed_source[email_id] = source
+
+    def _unindex(self, email_id: str):
+        source = self._indexed_source.pop(email_id, None)
+        if source is not None:
+            self._by_source[source].pop(email_id, None)
+
+    def _reindex(self):
+        self._by_source.clear()
+        self._indexed_source.clear()
+        for email in self._emails.values():
+            self._index(email)
+
+    def _put(self, email: Dict):
+        self._emails[email.get("id")] = email
+        self._index(email)
+
+    def _remove(self, email_id: str) -> Optional[Dict]:
+        self._unindex(email_id)
+        return self._emails.pop(email_id, None)
+
+    def _read_email_file(self, path: str) -> List[Dict]:
+        if not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+
+    def _row(self, email: Dict) -> tuple:
+        return (
+            email.get("id"),
+            email.get("source"),
+            int(email.get("internal_date") or 0),
+            orjson.dumps(email),
+        )
+
+    def _persist(self, email_ids: Iterable[str]):
+        """Write the given emails to the database, deleting ids no longer in the store."""
+        self._invalidate_cache()
+        # Memory has changed even when the database write is deferred to the end of bulk()
+        self._version += 1
+        pending = _bulk_pending.get()
+        if pending is not None:
+            pending.update(email_ids)
+            return
+        rows = []
+        deleted = []
+        for email_id in email_ids:
+            email = self._emails.get(email_id)
+            if email is None:
+                deleted.append((email_id,))
+            else:
+                rows.append(self._row(email))
+        with self._lock, db.transaction(self._db):
+            if rows:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO emails (id, source, internal_date, doc) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+            if deleted:
+                self._db.executemany("DELETE FROM emails WHERE id = ?", deleted)
+
+    @contextmanager
+    def bulk(self):
+        """Batch the caller's upserts into a single database transaction.
+        Writes made by other requests meanwhile still go straight to the database."""
+        if _bulk_pending.get() is not None:
+            # Nested block: the outermost one does the write
+            yield
+            return
+        email_ids = set()
+        _bulk_pending.set(email_ids)
+        try:
+            yield
+        finally:
+            # Cleared rather than reset with a token, since an async generator holding
+            # the block may be closed from a different context
+            _bulk_pending.set(None)
+            if email_ids:
+                self._persist(email_ids)
+
+    def get_version(self) -> int:
+        """A counter that changes whenever any email is added, updated or deleted."""
+        return self._version
+
     def get_emails(self) -> List[Dict]:
         """Get all emails (mock + gmail combined)."""
-        mock_emails = []
-        gmail_emails = []
-        mock_drafts = []
-        gmail_drafts = []
-        
-        if os.path.exists(INBOX_FILE):
-            with open(INBOX_FILE, 'r') as f:
-                mock_emails = json.load(f)
-        
-        if os.path.exists(GMAIL_INBOX_FILE):
-            with open(GMAIL_INBOX_FILE, 'r') as f:
-                gmail_emails = json.load(f)
-        
-        if os.path.exists(DRAFTS_FILE):
-            with open(DRAFTS_FILE, 'r') as f:
-                mock_drafts = json.load(f)
-        
-        if os.path.exists(GMAIL_DRAFTS_FILE):
-            with open(GMAIL_DRAFTS_FILE, 'r') as f:
-                gmail_drafts = json.load(f)
-        
-        # Combine all lists
-        return mock_emails + gmail_emails + mock_drafts + gmail_drafts
+        return list(self._emails.values())
+
+    def get_recent_emails(self, limit: int) -> List[Dict]:
+        """Get the most recent emails, newest first."""
+        with self._lock:
+            if self._sorted_cache is None:
+                self._sorted_cache = sorted(
+                    self._emails.values(),
+                    key=lambda x: x.get('timestamp') or '',
+                    reverse=True
+                )
+            return self._sorted_cache[:limit]
+
+    def _invalidate_cache(self):
+        self._sorted_cache = None
+
+    def get_by_source(self, source: str) -> List[Dict]:
+        """Get the emails from a single source."""
+        return list(self._by_source.get(source, {}).values())
+
+    def get_excluding_sources(self, sources: Iterable[str]) -> List[Dict]:
+        """Get the emails from every source except the given ones."""
+        with self._lock:
+            excluded = set(sources)
+            return [
+                email
+                for source, emails in self._by_source.items() if source not in excluded
+                for email in emails.values()
+            ]
 
     def save_emails(self, emails: List[Dict]):
-        """Save emails to appropriate files based on source."""
-        # Gmail emails go to gmail_inbox.json
-        gmail_emails = [e for e in emails if e.get("source") == "gmail"]
-        # Gmail drafts go to gmail_drafts.json
-        gmail_drafts = [e for e in emails if e.get("source") == "gmail_draft"]
-        # Mock/system drafts go to drafts.json
-        mock_drafts = [e for e in emails if e.get("source") in ["draft", "mock_draft"]]
-        # Everything else (mock, system, ingestion) goes to inbox.json
-        mock_emails = [e for e in emails if e.get("source") not in ["gmail", "gmail_draft", "draft", "mock_draft"]]
-        
-        with open(INBOX_FILE, 'w') as f:
-            json.dump(mock_emails, f, indent=2)
-        
-        with open(GMAIL_INBOX_FILE, 'w') as f:
-            json.dump(gmail_emails, f, indent=2)
-        
-        with open(DRAFTS_FILE, 'w') as f:
-            json.dump(mock_drafts, f, indent=2)
-        
-        with open(GMAIL_DRAFTS_FILE, 'w') as f:
-            json.dump(gmail_drafts, f, indent=2)
+        """Replace the whole inbox and save it to the database."""
+        with self._lock:
+            email_ids = set(self._emails)
+            self._emails = OrderedDict((e.get("id"), e) for e in emails)
+            self._reindex()
+            self._persist(email_ids | set(self._emails))
+
+    def _read_cached(self, path: str) -> Dict:
+        """Read a JSON file, reusing the parsed copy until its mtime changes."""
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._file_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r') as f:
+            data = json.load(f)
+        self._file_cache[path] = (mtime, data)
+        return data
+
+    def _write_cached(self, path: str, data: Dict):
+        _write_json_atomic(path, data)
+        self._file_cache[path] = (os.stat(path).st_mtime_ns, data)
 
     def get_prompts(self) -> Dict:
-        with open(PROMPTS_FILE, 'r') as f:
-            return json.load(f)
+        return self._read_cached(PROMPTS_FILE)
 
     def save_prompts(self, prompts: Dict):
-        with open(PROMPTS_FILE, 'w') as f:
-            json.dump(prompts, f, indent=2)
+        self._write_cached(PROMPTS_FILE, prompts)
 
     def get_settings(self) -> Dict:
-        with open(SETTINGS_FILE, 'r') as f:
-            return json.load(f)
+        return self._read_cached(SETTINGS_FILE)
 
     def save_settings(self, settings: Dict):
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(settings, f, indent=2)
+        self._write_cached(SETTINGS_FILE, settings)
 
     def upsert_email(self, email: Dict):
         """Add or update a single email."""
-        emails = self.get_emails()
-        for i, existing in enumerate(emails):
-            if existing.get("id") == email.get("id"):
-                emails[i] = email
-                self.save_emails(emails)
-                return
-        emails.append(email)
-        self.save_emails(emails)
+        self.upsert_many([email])
 
     def upsert_many(self, new_emails: List[Dict]):
         """Add or update multiple emails."""
-        emails = self.get_emails()
-        email_map = {e.get("id"): e for e in emails}
-        for new_email in new_emails:
-            email_map[new_email.get("id")] = new_email
-        self.save_emails(list(email_map.values()))
+        with self._lock:
+            for new_email in new_emails:
+                self._put(new_email)
+            self._persist([e.get("id") for e in new_emails])
 
     def get_email(self, email_id: str) -> Optional[Dict]:
         """Get a single email by ID."""
-        emails = self.get_emails()
-        for email in emails:
-            if email.get("id") == email_id:
-                return email
-        return None
+        return self._emails.get(email_id)
+
+    def update_email(self, email_id: str, patch: Dict) -> Optional[Dict]:
+        """Apply a partial update to an email. Returns None if it doesn't exist."""
+        with self._lock:
+            email = self._emails.get(email_id)
+            if email is None:
+                return None
+            email.update(patch)
+            self._index(email)
+            self._persist([email_id])
+            return email
+
+    def delete_email(self, email_id: str) -> Optional[Dict]:
+        """Delete an email. Returns the removed email, or None if it doesn't exist."""
+        with self._lock:
+            email = self._remove(email_id)
+            if email is not None:
+                self._persist([email_id])
+            return email
 
     def count_emails(self) -> int:
         """Count total emails."""
-        return len(self.get_emails())
+        return len(self._emails)
 
     def clear_all_emails(self):
         """Clear all emails."""
-        with open(INBOX_FILE, 'w') as f:
-            json.dump([], f)
-        with open(GMAIL_INBOX_FILE, 'w') as f:
-            json.dump([], f)
-        with open(DRAFTS_FILE, 'w') as f:
-            json.dump([], f)
-        with open(GMAIL_DRAFTS_FILE, 'w') as f:
-            json.dump([], f)
+        with self._lock:
+            email_ids = list(self._emails)
+            self._emails.clear()
+            self._reindex()
+            self._persist(email_ids)
+
+    def clear_gmail_emails(self):
+        """Clear synced Gmail emails, leaving mock emails and drafts untouched."""
+        with self._lock:
+            email_ids = [email.get("id") for email in self.get_by_source("gmail")]
+            for email_id in email_ids:
+                self._remove(email_id)
+            self._persist(email_ids)
 
     def get_sync_state(self, key: str) -> Optional[str]:
         """Get a sync state value."""
-        with open(SYNC_STATE_FILE, 'r') as f:
-            state = json.load(f)
-        return state.get(key)
+        return self._sync_state.get(key)
 
     def set_sync_state(self, key: str, value: str):
         """Set a sync state value."""
-        with open(SYNC_STATE_FILE, 'r') as f:
-            state = json.load(f)
-        state[key] = value
-        with open(SYNC_STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
+        with self._sync_state_lock:
+            self._sync_state[key] = value
+            _write_json_atomic(SYNC_STATE_FILE, self._sync_state)
 
     def delete_sync_state(self, key: str):
         """Delete a sync state value."""
-        with open(SYNC_STATE_FILE, 'r') as f:
-            state = json.load(f)
-        state.pop(key, None)
-        with open(SYNC_STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
+        with self._sync_state_lock:
+            if self._sync_state.pop(key, None) is not None:
+                _write_json_atomic(SYNC_STATE_FILE, self._sync_state)
 
     def load_mock_inbox(self) -> List[Dict]:
-        """Load mock emails from inbox.json."""
-        if not os.path.exists(INBOX_FILE):
-            return []
-        with open(INBOX_FILE, 'r') as f:
-            emails = json.load(f)
-        # Only clear and reload mock emails, leave Gmail inbox untouched
-        with open(INBOX_FILE, 'w') as f:
-            json.dump(emails, f, indent=2)
-        return emails
+        """Get the mock emails currently in the inbox, with their categories and read state."""
+        return self.get_excluding_sources(NON_MOCK_SOURCES)
 
 inbox_service = InboxService()
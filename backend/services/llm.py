@@ -1,15 +1,47 @@
 import os
 import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+import httpx
 import ollama
-from groq import Groq
-from typing import Optional
+from groq import AsyncGroq, Groq
+from typing import AsyncIterator, List, Optional, Tuple
+
+# Upper bound on concurrent in-flight requests to the LLM provider
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+
+# Connection pool shared by every async request so TLS handshakes are paid once
+LLM_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+# Completions remembered per (provider, model, prompt) so repeated prompts skip the model
+LLM_CACHE_SIZE = 256
+
+class LLMStreamError(Exception):
+    """Raised by generate_stream() when the provider fails, so the error never reaches the answer text."""
 
 class LLMService:
     def __init__(self):
         self.provider = "ollama"
         self.groq_client = None
+        self.async_groq_client = None
+        # Blocking calls (e.g. /draft) share their own keep-alive pool
+        self._http_client = httpx.Client(
+            http2=True,
+            timeout=httpx.Timeout(60.0),
+            limits=LLM_HTTP_LIMITS,
+        )
+        self.ollama_client = ollama.Client(http2=True, limits=LLM_HTTP_LIMITS)
+        self._async_http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(60.0),
+            limits=LLM_HTTP_LIMITS,
+        )
+        self.async_ollama_client = ollama.AsyncClient(http2=True, limits=LLM_HTTP_LIMITS)
         self.model = "llama3.1:8b" # Default for Ollama
         self.groq_model = "llama-3.1-8b-instant" # Default for Groq
+        self._semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+        self._cache: "OrderedDict[Tuple[str, str, bytes], str]" = OrderedDict()
 
     def update_settings(self, provider: str, groq_api_key: Optional[str] = None, groq_model: Optional[str] = None, ollama_model: Optional[str] = None):
         self.provider = provider
@@ -19,12 +51,45 @@ class LLMService:
             self.model = ollama_model
             
         if provider == "groq" and groq_api_key:
-            self.groq_client = Groq(api_key=groq_api_key)
+            self.groq_client = Groq(api_key=groq_api_key, http_client=self._http_client)
+            self.async_groq_client = AsyncGroq(api_key=groq_api_key, http_client=self._async_http_client)
+        self.clear_cache()
+
+    def _cache_key(self, prompt: str) -> Tuple[str, str, bytes]:
+        model = self.model if self.provider == "ollama" else self.groq_model
+        return self.provider, model, hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+
+    def _cache_get(self, key: Tuple[str, str, bytes]) -> Optional[str]:
+        response = self._cache.get(key)
+        if response is not None:
+            self._cache.move_to_end(key)
+        return response
+
+    def _cache_put(self, key: Tuple[str, str, bytes], response: str):
+        # Errors are never cached so the next call retries
+        if response.startswith("Error"):
+            return
+        self._cache[key] = response
+        if len(self._cache) > LLM_CACHE_SIZE:
+            self._cache.popitem(last=False)
 
-    def generate(self, prompt: str) -> str:
+    def clear_cache(self):
+        self._cache.clear()
+
+    def generate(self, prompt: str, use_cache: bool = True) -> str:
+        key = self._cache_key(prompt)
+        if use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached
+        response = self._generate(prompt)
+        self._cache_put(key, response)
+        return response
+
+    def _generate(self, prompt: str) -> str:
         if self.provider == "ollama":
             try:
-                response = ollama.generate(model=self.model, prompt=prompt)
+                response = self.ollama_client.generate(model=self.model, prompt=prompt)
                 return response['response']
             except Exception as e:
                 return f"Error calling Ollama: {str(e)}"
@@ -46,4 +111,84 @@ class LLMService:
                 return f"Error calling Groq: {str(e)}"
         return "Error: Invalid provider."
 
+    async def agenerate(self, prompt: str, use_cache: bool = True) -> str:
+        """Async variant of generate() so independent prompts can run concurrently."""
+        key = self._cache_key(prompt)
+        if use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached
+        response = await self._agenerate(prompt)
+        self._cache_put(key, response)
+        return response
+
+    async def _agenerate(self, prompt: str) -> str:
+        async with self._semaphore:
+            if self.provider == "ollama":
+                try:
+                    response = await self.async_ollama_client.generate(model=self.model, prompt=prompt)
+                    return response['response']
+                except Exception as e:
+                    return f"Error calling Ollama: {str(e)}"
+            elif self.provider == "groq":
+                if not self.async_groq_client:
+                    return "Error: Groq API Key not configured."
+                try:
+                    chat_completion = await self.async_groq_client.chat.completions.create(
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": prompt,
+                            }
+                        ],
+                        model=self.groq_model,
+                    )
+                    return chat_completion.choices[0].message.content
+                except Exception as e:
+                    return f"Error calling Groq: {str(e)}"
+            return "Error: Invalid provider."
+
+    async def generate_stream(self, prompt: str) -> AsyncIterator[str]:
+        """Yield the completion in chunks as the provider produces them."""
+        async with self._semaphore:
+            if self.provider == "ollama":
+                try:
+                    async for chunk in await self.async_ollama_client.generate(
+                        model=self.model, prompt=prompt, stream=True
+                    ):
+                        yield chunk['response']
+                except Exception as e:
+                    raise LLMStreamError(f"Error calling Ollama: {str(e)}") from e
+            elif self.provider == "groq":
+                if not self.async_groq_client:
+                    raise LLMStreamError("Error: Groq API Key not configured.")
+                try:
+                    stream = await self.async_groq_client.chat.completions.create(
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": prompt,
+                            }
+                        ],
+                        model=self.groq_model,
+                        stream=True,
+                    )
+                    async for chunk in stream:
+                        yield chunk.choices[0].delta.content or ""
+                except Exception as e:
+                    raise LLMStreamError(f"Error calling Groq: {str(e)}") from e
+            else:
+                raise LLMStreamError("Error: Invalid provider.")
+
+    async def close(self):
+        """Close the pooled HTTP connections."""
+        self._http_client.close()
+        self.ollama_client.close()
+        await self._async_http_client.aclose()
+        await self.async_ollama_client.close()
+
+    async def agenerate_batch(self, prompts: List[str]) -> List[str]:
+        """Generate completions for several prompts concurrently, in input order."""
+        return list(await asyncio.gather(*(self.agenerate(prompt) for prompt in prompts)))
+
 llm_service = LLMService()
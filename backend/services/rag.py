@@ -1,53 +1,343 @@
 import os
 import uuid
-from typing import List, Dict, Any, Optional
+import asyncio
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Any, Generator, Optional, Tuple, Union
 import chromadb
+import httpx
+import numpy as np
 from chromadb.config import Settings as ChromaSettings
-import ollama
+from chromadb.errors import NotFoundError
 from datetime import datetime
 
+# (ids, distances, metadatas, documents) as returned by query_context(return_raw=True)
+RawContexts = Tuple[List[str], np.ndarray, List[Dict[str, Any]], List[str]]
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+if "://" not in OLLAMA_HOST:
+    OLLAMA_HOST = f"http://{OLLAMA_HOST}"
+
+# Texts sent to Ollama per embedding request, and documents per Chroma add
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+CHROMA_ADD_BATCH_SIZE = int(os.getenv("CHROMA_ADD_BATCH_SIZE", "250"))
+
+# Embedding requests allowed in flight at once during async indexing, and retries per request
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_RETRIES = 2
+
+# Single-document writes are queued and added by a background thread in batches of up
+# to WRITE_BATCH_SIZE, waiting at most WRITE_BATCH_WAIT seconds for a batch to fill
+WRITE_QUEUE_SIZE = 1000
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_WAIT = 0.25
+# Attempts at a failed batch write before its documents are reported as lost
+WRITE_RETRIES = 2
+
+# Embeddings remembered by a hash of the text, so repeated queries and the quoted
+# text shared by emails in a thread skip Ollama
+EMBED_CACHE_SIZE = 2048
+
+# Emails are indexed in a cosine-space collection; it replaced the default (squared L2)
+# collection, which migrate_legacy_collection() drops once its chat turns are moved out
+COLLECTION_NAME = "email_context"
+LEGACY_COLLECTION_NAME = "email_chat_history"
+
+# HNSW parameters pinned so recall and query latency don't drift as the index grows
+COLLECTION_METADATA = {
+    "description": "Email and action items context for semantic search",
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:search_ef": 64,
+}
+
+# Chat turns are only ever looked up by session, so they live in their own collection
+# without real embeddings; Chroma still requires a vector, so each gets the same placeholder
+CHAT_TURNS_COLLECTION_NAME = "chat_turns"
+CHAT_TURN_EMBEDDING = [0.0]
+
+# Connection pool for embedding requests, kept warm so handshakes are paid once
+EMBED_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0)
+
+# Embedding requests go straight to Ollama's HTTP API over one client shared by every RAGService
+_embed_client = httpx.Client(
+    base_url=OLLAMA_HOST,
+    http2=True,
+    limits=EMBED_HTTP_LIMITS,
+    timeout=httpx.Timeout(120.0, connect=10.0),
+)
+_aembed_client = httpx.AsyncClient(
+    base_url=OLLAMA_HOST,
+    http2=True,
+    limits=EMBED_HTTP_LIMITS,
+    timeout=httpx.Timeout(120.0, connect=10.0),
+)
+
+# Shared by every RAGService so repeated ingestion runs hit the same cache
+_embedding_cache: "OrderedDict[Tuple[str, bytes], np.ndarray]" = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+
+class EmbeddingUnavailable(Exception):
+    """Raised when Ollama can't embed a text, so nothing is stored for it"""
+
+
+class VectorStoreWriteError(Exception):
+    """Raised by flush() when queued writes couldn't be added to the vector store"""
+
+
+def _turn_order(turn: Dict[str, Any]) -> int:
+    """Sort key putting chat turns in the order they were added"""
+    # Turns stored before timestamp_ms existed sort first, in storage order
+    return turn['metadata'].get('timestamp_ms', 0)
+
+
+def _clip(text: str, limit: int) -> str:
+    """Cut text to at most limit characters, without copying text that already fits"""
+    return text if len(text) <= limit else text[:limit]
+
 
 class RAGService:
     """
     RAG service for email semantic search using Ollama embeddinggemma and ChromaDB.
     Stores email content and action items for semantic retrieval.
-    Does NOT store chat history - only email and action item context.
+    Chat turns are kept in a separate, store-only collection and are not searched.
     """
     
     def __init__(self, persist_directory: str = None):
-        # Default to DATA_DIR/chroma_db
-        if persist_directory is None:
-            from services.inbox import DATA_DIR
-            persist_directory = os.path.join(DATA_DIR, "chroma_db")
+        self.persist_directory = persist_directory
+        self.embedding_model = "embeddinggemma:latest"
         
-        os.makedirs(persist_directory, exist_ok=True)
+        # Chroma is opened, and the writer thread started, on first use
+        self._client = None
+        self._collection = None
+        self._chat_turns = None
+        self._writer: Optional[threading.Thread] = None
+        self._init_lock = threading.RLock()
         
-        # Initialize ChromaDB with persistence
-        self.client = chromadb.PersistentClient(
-            path=persist_directory,
-            settings=ChromaSettings(
-                anonymized_telemetry=False,
-                allow_reset=True
-            )
-        )
+        # Entries are (collection attribute, doc_id, embedding, document, metadata)
+        self._write_queue: "queue.Queue[Tuple[str, str, Any, str, Dict[str, Any]]]" = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        # IDs of queued documents the writer gave up on, reported by the next flush()
+        self._failed_writes: List[str] = []
+        self._failed_writes_lock = threading.Lock()
+    
+    @property
+    def client(self):
+        if self._client is None:
+            with self._init_lock:
+                if self._client is None:
+                    # Default to DATA_DIR/chroma_db
+                    persist_directory = self.persist_directory
+                    if persist_directory is None:
+                        from services.inbox import DATA_DIR
+                        persist_directory = os.path.join(DATA_DIR, "chroma_db")
+                    
+                    os.makedirs(persist_directory, exist_ok=True)
+                    
+                    # Initialize ChromaDB with persistence
+                    self._client = chromadb.PersistentClient(
+                        path=persist_directory,
+                        settings=ChromaSettings(
+                            anonymized_telemetry=False,
+                            allow_reset=True
+                        )
+                    )
+        return self._client
+    
+    @property
+    def collection(self):
+        if self._collection is None:
+            with self._init_lock:
+                if self._collection is None:
+                    # Create or get collection for email context
+                    self._collection = self.client.get_or_create_collection(
+                        name=COLLECTION_NAME,
+                        metadata=COLLECTION_METADATA
+                    )
+        return self._collection
+    
+    def migrate_legacy_collection(self) -> bool:
+        """
+        Move off the pre-cosine collection, if one is left from an older version.
+        Its chat turns are copied into the chat turn store and the collection is dropped;
+        returns True when that happened, since the emails it held need re-indexing.
+        """
+        try:
+            legacy = self.client.get_collection(name=LEGACY_COLLECTION_NAME)
+        except NotFoundError:
+            return False
+        except Exception as e:
+            print(f"Error opening legacy collection: {e}")
+            return False
         
-        # Create or get collection for chat history
-        self.collection = self.client.get_or_create_collection(
-            name="email_chat_history",
-            metadata={"description": "Email and action items context for semantic search"}
-        )
+        try:
+            turns = legacy.get(where={"type": "chat_turn"}, include=["documents", "metadatas"])
+            if turns['ids']:
+                self.chat_turns.upsert(
+                    ids=turns['ids'],
+                    embeddings=[CHAT_TURN_EMBEDDING] * len(turns['ids']),
+                    documents=turns['documents'],
+                    metadatas=turns['metadatas']
+                )
+            dropped = legacy.count() - len(turns['ids'])
+            self.client.delete_collection(name=LEGACY_COLLECTION_NAME)
+        except Exception as e:
+            print(f"Error migrating legacy collection: {e}")
+            return False
         
-        self.embedding_model = "embeddinggemma:latest"
+        print(
+            f"Migrated legacy collection '{LEGACY_COLLECTION_NAME}': moved {len(turns['ids'])} chat turns, "
+            f"dropped {dropped} email embeddings to be re-indexed"
+        )
+        return True
     
-    def _generate_embedding(self, text: str) -> List[float]:
+    @property
+    def chat_turns(self):
+        if self._chat_turns is None:
+            with self._init_lock:
+                if self._chat_turns is None:
+                    self._chat_turns = self.client.get_or_create_collection(
+                        name=CHAT_TURNS_COLLECTION_NAME,
+                        metadata={"description": "Chat turns, looked up by session"}
+                    )
+        return self._chat_turns
+    
+    def _enqueue_write(
+        self,
+        document: str,
+        metadata: Dict[str, Any],
+        embedding: Union[np.ndarray, List[float]],
+        target: str = "collection"
+    ) -> str:
+        """
+        Queue a document for the background writer and return its ID straight away.
+        target names the collection attribute to write to.
+        """
+        if self._writer is None:
+            with self._init_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="rag-writer", daemon=True)
+                    self._writer.start()
+        doc_id = str(uuid.uuid4())
+        self._write_queue.put((target, doc_id, embedding, document, metadata))
+        return doc_id
+    
+    def _write_loop(self):
+        """Drain the write queue, adding queued documents to the collection in batches"""
+        while True:
+            batch = [self._write_queue.get()]
+            deadline = time.monotonic() + WRITE_BATCH_WAIT
+            while len(batch) < WRITE_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._write_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            by_target: Dict[str, List[tuple]] = {}
+            for target, *entry in batch:
+                by_target.setdefault(target, []).append(entry)
+            try:
+                for target, entries in by_target.items():
+                    self._write_entries(target, entries)
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+    
+    def _write_entries(self, target: str, entries: List[tuple]):
+        """Add queued entries to one collection, retrying before recording them as lost"""
+        ids, embeddings, documents, metadatas = (list(column) for column in zip(*entries))
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                # Upsert, so a retry after a partial write doesn't trip over IDs already added
+                getattr(self, target).upsert(
+                    ids=ids,
+                    embeddings=embeddings,
+                    documents=documents,
+                    metadatas=metadatas
+                )
+                return
+            except Exception as e:
+                print(f"Error writing to vector store (attempt {attempt + 1}): {e}")
+                if attempt < WRITE_RETRIES:
+                    time.sleep(0.5 * 2 ** attempt)
+        print(f"Dropped {len(ids)} queued writes to {target}: {', '.join(ids)}")
+        with self._failed_writes_lock:
+            self._failed_writes.extend(ids)
+    
+    def _wait_for_writes(self):
+        """Block until the write queue is drained, so reads see every queued document"""
+        self._write_queue.join()
+    
+    def flush(self):
+        """
+        Wait until every queued write has reached the collection.
+        Raises VectorStoreWriteError if any were dropped since the last flush.
+        """
+        self._wait_for_writes()
+        with self._failed_writes_lock:
+            failed, self._failed_writes = self._failed_writes, []
+        if failed:
+            raise VectorStoreWriteError(f"{len(failed)} queued writes were lost: {', '.join(failed)}")
+    
+    def _generate_embedding(self, text: str) -> np.ndarray:
         """Generate embedding using Ollama's embeddinggemma model"""
-        try:
-            response = ollama.embeddings(model=self.embedding_model, prompt=text)
-            return response['embedding']
-        except Exception as e:
-            print(f"Error generating embedding: {e}")
-            # Fallback: return zero vector if embedding fails
-            return [0.0] * 768  # embeddinggemma typically has 768 dimensions
+        return self._generate_embeddings_batch([text])[0]
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """
+        Embed a search query, e.g. to reuse it across query_context calls.
+        Raises EmbeddingUnavailable if Ollama can't embed it.
+        """
+        return np.asarray(self._generate_embedding(query), dtype=np.float32)
+    
+    def _lookup_embeddings(
+        self,
+        texts: List[str]
+    ) -> Tuple[List[Tuple[str, bytes]], List[Optional[np.ndarray]], Dict[Tuple[str, bytes], str]]:
+        """
+        Look texts up in the embedding cache.
+        Returns (keys, embeddings, missing) where embeddings is None for cache misses
+        and missing maps each distinct uncached key to its text.
+        """
+        keys = [
+            (self.embedding_model, hashlib.blake2b(text.encode(), digest_size=16).digest())
+            for text in texts
+        ]
+        with _embedding_cache_lock:
+            embeddings = [_embedding_cache.get(key) for key in keys]
+            for key, embedding in zip(keys, embeddings):
+                if embedding is not None:
+                    _embedding_cache.move_to_end(key)
+        missing = {}
+        for key, text, embedding in zip(keys, texts, embeddings):
+            if embedding is None:
+                missing.setdefault(key, text)
+        return keys, embeddings, missing
+    
+    def _store_embeddings(
+        self,
+        keys: List[Tuple[str, bytes]],
+        embeddings: List[Optional[np.ndarray]],
+        missing: Dict[Tuple[str, bytes], str],
+        fetched: np.ndarray
+    ) -> np.ndarray:
+        """Cache freshly fetched embeddings and fill them into the cache misses"""
+        fetched_by_key = dict(zip(missing, fetched))
+        with _embedding_cache_lock:
+            _embedding_cache.update(fetched_by_key)
+            while len(_embedding_cache) > EMBED_CACHE_SIZE:
+                _embedding_cache.popitem(last=False)
+        return np.stack([
+            embedding if embedding is not None else fetched_by_key[key]
+            for key, embedding in zip(keys, embeddings)
+        ])
     
     def add_chat_turn(
         self,
@@ -57,18 +347,16 @@ class RAGService:
         session_id: Optional[str] = None
     ) -> str:
         """
-        Add a chat turn (user message + assistant response) to the vector store.
+        Add a chat turn (user message + assistant response) to the chat turn store.
+        Turns aren't embedded, so no Ollama call is made.
+        The write happens in the background; call flush() to wait for it.
         Returns the document ID.
         """
-        # Create unique ID for this chat turn
-        doc_id = str(uuid.uuid4())
-        
-        # Prepare metadata
+        # Prepare metadata; the messages themselves live in the document text
         metadata = {
             "timestamp": datetime.now().isoformat(),
+            "timestamp_ms": int(time.time() * 1000),
             "type": "chat_turn",
-            "user_message": user_message[:500],  # Store preview in metadata
-            "assistant_response": assistant_response[:500],
         }
         
         if session_id:
@@ -76,51 +364,119 @@ class RAGService:
         
         if email_context:
             metadata["email_id"] = email_context.get("id", "")
-            metadata["email_subject"] = email_context.get("subject", "")[:200]
-            metadata["email_sender"] = email_context.get("sender", "")[:200]
+            metadata["email_subject"] = _clip(email_context.get("subject", ""), 80)
+            metadata["email_sender"] = _clip(email_context.get("sender", ""), 80)
         
-        # Combine user message and assistant response for embedding
+        # Combine user message and assistant response
         # This captures the full conversation context
         combined_text = f"User: {user_message}\nAssistant: {assistant_response}"
         
         if email_context:
-            # Include email context in the embedding
+            # Include email context in the stored turn
             email_text = f"\nEmail Context - Subject: {email_context.get('subject', '')}\n"
             email_text += f"From: {email_context.get('sender', '')}\n"
-            email_text += f"Body: {email_context.get('body', '')[:1000]}"
+            # Trailing whitespace is just wasted space
+            body_preview = _clip(email_context.get('body', ''), 1000).rstrip()
+            email_text += f"Body: {body_preview}"
             combined_text += email_text
         
-        # Generate embedding
-        embedding = self._generate_embedding(combined_text)
-        
         # Add to ChromaDB
-        self.collection.add(
-            ids=[doc_id],
-            embeddings=[embedding],
-            documents=[combined_text],
-            metadatas=[metadata]
-        )
-        
-        return doc_id
+        return self._enqueue_write(combined_text, metadata, CHAT_TURN_EMBEDDING, target="chat_turns")
     
-    def add_email_context(
+    def _generate_embeddings_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Generate embeddings for several texts, asking Ollama only for uncached ones.
+        Returns a float32 array with one row per text.
+        """
+        keys, embeddings, missing = self._lookup_embeddings(texts)
+        if not missing:
+            return np.stack(embeddings)
+        fetched = self._request_embeddings(list(missing.values()))
+        return self._store_embeddings(keys, embeddings, missing, fetched)
+    
+    def _embed_exchange(
         self,
-        email: Dict[str, Any],
-        session_id: Optional[str] = None
-    ) -> str:
+        texts: List[str]
+    ) -> Generator[Tuple[str, Dict[str, Any]], httpx.Response, np.ndarray]:
         """
-        Add email content to the vector store for future reference.
-        This is useful when a user views/selects an email.
+        The Ollama requests needed to embed texts, independent of the HTTP client.
+        Yields (path, payload) for each request, expects the response to be sent back,
+        and returns the embeddings; the sync and async callers only do the I/O.
         """
-        doc_id = str(uuid.uuid4())
-        
+        response = yield "/api/embed", {"model": self.embedding_model, "input": texts}
+        # Older Ollama servers don't have /api/embed (404) or don't return "embeddings";
+        # they only have the one-text-per-request endpoint
+        if response.status_code != 404:
+            response.raise_for_status()
+            embeddings = response.json().get("embeddings")
+            if embeddings is not None:
+                # Straight from the parsed JSON to float32, without per-vector Python lists
+                return np.asarray(embeddings, dtype=np.float32)
+        embeddings = []
+        for text in texts:
+            response = yield "/api/embeddings", {"model": self.embedding_model, "prompt": text}
+            response.raise_for_status()
+            embeddings.append(response.json()["embedding"])
+        return np.asarray(embeddings, dtype=np.float32)
+    
+    def _request_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Embed several texts in a single Ollama /api/embed request"""
+        try:
+            exchange = self._embed_exchange(texts)
+            path, payload = next(exchange)
+            while True:
+                try:
+                    path, payload = exchange.send(_embed_client.post(path, json=payload))
+                except StopIteration as done:
+                    return done.value
+        except Exception as e:
+            print(f"Error generating embeddings: {e}")
+            raise EmbeddingUnavailable(str(e)) from e
+    
+    async def _aembed_batch(self, texts: List[str]) -> np.ndarray:
+        """Async variant of _generate_embeddings_batch()"""
+        keys, embeddings, missing = self._lookup_embeddings(texts)
+        if not missing:
+            return np.stack(embeddings)
+        fetched = await self._arequest_embeddings(list(missing.values()))
+        return self._store_embeddings(keys, embeddings, missing, fetched)
+    
+    async def _arequest_embeddings(self, texts: List[str]) -> np.ndarray:
+        """
+        Async variant of _request_embeddings(). A failed request is retried
+        EMBED_RETRIES times so one bad batch doesn't cost a whole indexing run.
+        """
+        error = None
+        for attempt in range(EMBED_RETRIES + 1):
+            try:
+                exchange = self._embed_exchange(texts)
+                path, payload = next(exchange)
+                while True:
+                    try:
+                        path, payload = exchange.send(await _aembed_client.post(path, json=payload))
+                    except StopIteration as done:
+                        return done.value
+            except Exception as e:
+                print(f"Error generating embeddings (attempt {attempt + 1}): {e}")
+                error = e
+                if attempt < EMBED_RETRIES:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+        raise EmbeddingUnavailable(str(error)) from error
+    
+    def _build_email_document(
+        self,
+        email: Dict[str, Any],
+        session_id: Optional[str] = None,
+        timestamp: Optional[str] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        """Build the document text and metadata stored for an email"""
         metadata = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": timestamp or datetime.now().isoformat(),
             "type": "email_context",
             "email_id": email.get("id", ""),
-            "email_subject": (email.get("subject", "") or "")[:200],
-            "email_sender": (email.get("sender", "") or "")[:200],
-            "email_category": (email.get("category", "") or "")[:100],
+            "email_subject": _clip(email.get("subject", "") or "", 80),
+            "email_sender": _clip(email.get("sender", "") or "", 80),
+            "email_category": _clip(email.get("category", "") or "", 100),
             "source": email.get("source", "unknown")  # Track if gmail or mock inbox
         }
         
@@ -153,31 +509,217 @@ class RAGService:
                     email_text += f"{idx}. {task}\n"
             email_text += "=== END ACTION ITEMS ===\n"
         
-        embedding = self._generate_embedding(email_text)
+        # Lets re-ingestion skip emails whose indexed text hasn't changed
+        metadata["content_hash"] = hashlib.blake2b(email_text.encode(), digest_size=16).hexdigest()
         
-        self.collection.add(
-            ids=[doc_id],
-            embeddings=[embedding],
-            documents=[email_text],
-            metadatas=[metadata]
+        return email_text, metadata
+    
+    def add_email_context(
+        self,
+        email: Dict[str, Any],
+        session_id: Optional[str] = None
+    ) -> str:
+        """
+        Add email content to the vector store for future reference.
+        This is useful when a user views/selects an email.
+        The write happens in the background; call flush() to wait for it.
+        Returns the document ID, or "" if the email couldn't be embedded.
+        """
+        email_text, metadata = self._build_email_document(email, session_id)
+        try:
+            embedding = self._generate_embedding(email_text)
+        except EmbeddingUnavailable:
+            return ""
+        return self._enqueue_write(email_text, metadata, embedding)
+    
+    def add_email_contexts(
+        self,
+        emails: List[Dict[str, Any]],
+        session_id: Optional[str] = None,
+        skip_unchanged: bool = False
+    ) -> List[str]:
+        """
+        Add several emails to the vector store at once.
+        Embeddings are generated EMBED_BATCH_SIZE texts per request and inserted
+        CHROMA_ADD_BATCH_SIZE documents per add.
+        With skip_unchanged, emails already indexed with identical content are skipped
+        and outdated copies of changed emails are replaced.
+        Emails in a batch Ollama couldn't embed are left out.
+        Returns the IDs of the documents added, in input order.
+        """
+        documents, metadatas, stale = self._prepare_email_documents(emails, session_id, skip_unchanged)
+        if not documents:
+            return []
+        
+        embeddings = []
+        for start in range(0, len(documents), EMBED_BATCH_SIZE):
+            batch = documents[start:start + EMBED_BATCH_SIZE]
+            try:
+                embeddings.extend(self._generate_embeddings_batch(batch))
+            except EmbeddingUnavailable:
+                embeddings.extend([None] * len(batch))
+        
+        return self._add_documents(documents, metadatas, embeddings, stale)
+    
+    async def add_email_contexts_async(
+        self,
+        emails: List[Dict[str, Any]],
+        session_id: Optional[str] = None,
+        skip_unchanged: bool = False
+    ) -> List[str]:
+        """
+        Async variant of add_email_contexts() that keeps up to EMBED_CONCURRENCY
+        embedding requests in flight instead of sending the batches one by one.
+        """
+        documents, metadatas, stale = await asyncio.to_thread(
+            self._prepare_email_documents, emails, session_id, skip_unchanged
         )
+        if not documents:
+            return []
         
-        return doc_id
+        # Each batch writes into its own slice, so embeddings stay in input order
+        embeddings: List[Optional[np.ndarray]] = [None] * len(documents)
+        semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+        
+        async def embed_batch(start: int):
+            end = start + EMBED_BATCH_SIZE
+            async with semaphore:
+                try:
+                    embeddings[start:end] = await self._aembed_batch(documents[start:end])
+                except EmbeddingUnavailable:
+                    pass
+        
+        await asyncio.gather(*(embed_batch(start) for start in range(0, len(documents), EMBED_BATCH_SIZE)))
+        return await asyncio.to_thread(self._add_documents, documents, metadatas, embeddings, stale)
+    
+    def _prepare_email_documents(
+        self,
+        emails: List[Dict[str, Any]],
+        session_id: Optional[str],
+        skip_unchanged: bool
+    ) -> Tuple[List[str], List[Dict[str, Any]], Dict[str, List[str]]]:
+        """
+        Build the documents and metadata to index, dropping unchanged emails if asked.
+        Also returns email_id -> doc IDs of outdated copies of the emails being re-indexed.
+        """
+        documents = []
+        metadatas = []
+        # One clock read for the whole batch
+        timestamp = datetime.now().isoformat()
+        for email in emails:
+            email_text, metadata = self._build_email_document(email, session_id, timestamp)
+            documents.append(email_text)
+            metadatas.append(metadata)
+        
+        stale: Dict[str, List[str]] = {}
+        if skip_unchanged:
+            indexed = self._get_indexed_emails([m["email_id"] for m in metadatas])
+            fresh = [
+                i for i, m in enumerate(metadatas)
+                if m["content_hash"] not in indexed.get(m["email_id"], {})
+            ]
+            # Outdated copies are deleted by _add_documents once their replacements are stored
+            for i in fresh:
+                email_id = metadatas[i]["email_id"]
+                if indexed.get(email_id):
+                    stale[email_id] = list(indexed[email_id].values())
+            documents = [documents[i] for i in fresh]
+            metadatas = [metadatas[i] for i in fresh]
+        
+        return documents, metadatas, stale
+    
+    def _add_documents(
+        self,
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+        embeddings: List[Optional[np.ndarray]],
+        stale: Optional[Dict[str, List[str]]] = None
+    ) -> List[str]:
+        """
+        Insert embedded documents into the collection in CHROMA_ADD_BATCH_SIZE chunks.
+        Documents whose embedding is None are skipped. After each chunk is stored, the
+        stale copies (email_id -> doc IDs) of the emails in it are deleted, so an email
+        that couldn't be re-embedded keeps its old copy.
+        """
+        if any(embedding is None for embedding in embeddings):
+            kept = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+            documents = [documents[i] for i in kept]
+            metadatas = [metadatas[i] for i in kept]
+            embeddings = [embeddings[i] for i in kept]
+        if not documents:
+            return []
+        # One (n, dim) float32 array; each Chroma add gets a slice of it
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        doc_ids = [str(uuid.uuid4()) for _ in documents]
+        for start in range(0, len(documents), CHROMA_ADD_BATCH_SIZE):
+            end = start + CHROMA_ADD_BATCH_SIZE
+            self.collection.add(
+                ids=doc_ids[start:end],
+                embeddings=embeddings[start:end],
+                documents=documents[start:end],
+                metadatas=metadatas[start:end]
+            )
+            if stale:
+                replaced = list(dict.fromkeys(
+                    doc_id
+                    for metadata in metadatas[start:end]
+                    for doc_id in stale.get(metadata["email_id"], ())
+                ))
+                if replaced:
+                    self.collection.delete(ids=replaced)
+        
+        return doc_ids
+    
+    async def close(self):
+        """Finish queued writes and close the pooled embedding connections."""
+        try:
+            await asyncio.to_thread(self.flush)
+        except VectorStoreWriteError as e:
+            print(f"Error finishing queued writes: {e}")
+        _embed_client.close()
+        await _aembed_client.aclose()
+    
+    def _get_indexed_emails(self, email_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        """Map email_id -> {content_hash: doc_id} for emails already in the collection"""
+        indexed: Dict[str, Dict[str, str]] = {}
+        if not email_ids:
+            # Chroma rejects an empty $in list
+            return indexed
+        self._wait_for_writes()
+        try:
+            results = self.collection.get(
+                where={"$and": [
+                    {"type": "email_context"},
+                    {"email_id": {"$in": list(set(email_ids))}}
+                ]},
+                include=["metadatas"]
+            )
+        except Exception as e:
+            print(f"Error looking up indexed emails: {e}")
+            return indexed
+        
+        for doc_id, metadata in zip(results['ids'], results['metadatas']):
+            # Documents indexed before hashes were stored never match, so they are re-indexed once
+            content_hash = metadata.get("content_hash") or doc_id
+            indexed.setdefault(metadata.get("email_id", ""), {})[content_hash] = doc_id
+        return indexed
     
     def query_context(
         self,
         query: str,
         top_k: int = 5,
         session_id: Optional[str] = None,
-        email_id: Optional[str] = None
-    ) -> List[Dict[str, Any]]:
+        email_id: Optional[str] = None,
+        return_raw: bool = False,
+        query_embedding: Optional[np.ndarray] = None
+    ) -> Union[List[Dict[str, Any]], RawContexts]:
         """
         Query the vector store for relevant context.
         Returns top-k most relevant documents with their metadata.
+        Pass query_embedding (from embed_query) to skip embedding the query again.
+        With return_raw=True, returns (ids, distances, metadatas, documents) with the
+        distances as a NumPy array, so callers can filter without per-doc dicts.
         """
-        # Generate embedding for the query
-        query_embedding = self._generate_embedding(query)
-        
         # Build where filter if needed
         where_filter = None
         if session_id and email_id:
@@ -192,29 +734,44 @@ class RAGService:
         elif email_id:
             where_filter = {"email_id": email_id}
         
-        # Query ChromaDB
+        # Query ChromaDB; it clamps n_results to the matching documents itself
         try:
+            # Generate embedding for the query unless the caller already has it
+            if query_embedding is None:
+                query_embedding = self.embed_query(query)
             results = self.collection.query(
                 query_embeddings=[query_embedding],
-                n_results=min(top_k, self.collection.count()),
+                n_results=top_k,
                 where=where_filter,
                 include=["documents", "metadatas", "distances"]
             )
             
-            # Format results
-            contexts = []
-            if results and results['ids'] and len(results['ids']) > 0:
-                for i in range(len(results['ids'][0])):
-                    contexts.append({
-                        "id": results['ids'][0][i],
-                        "document": results['documents'][0][i],
-                        "metadata": results['metadatas'][0][i],
-                        "distance": results['distances'][0][i]
-                    })
+            if return_raw:
+                if not results or not results['ids']:
+                    return [], np.empty(0, dtype=np.float32), [], []
+                return (
+                    results['ids'][0],
+                    np.asarray(results['distances'][0], dtype=np.float32),
+                    results['metadatas'][0],
+                    results['documents'][0]
+                )
             
-            return contexts
+            # Format results
+            if not results or not results['ids']:
+                return []
+            return [
+                {"id": doc_id, "document": document, "metadata": metadata, "distance": distance}
+                for doc_id, document, metadata, distance in zip(
+                    results['ids'][0],
+                    results['documents'][0],
+                    results['metadatas'][0],
+                    results['distances'][0]
+                )
+            ]
         except Exception as e:
             print(f"Error querying context: {e}")
+            if return_raw:
+                return [], np.empty(0, dtype=np.float32), [], []
             return []
     
     def get_conversation_history(
@@ -226,24 +783,26 @@ class RAGService:
         Get recent conversation history for a session.
         Returns most recent chat turns.
         """
+        self._wait_for_writes()
         try:
-            results = self.collection.get(
-                where={"session_id": session_id, "type": "chat_turn"},
-                limit=limit,
+            # Chroma returns turns in storage order, so the newest are picked after sorting
+            results = self.chat_turns.get(
+                where={"session_id": session_id},
                 include=["documents", "metadatas"]
             )
             
             history = []
             if results and results['ids']:
-                for i in range(len(results['ids'])):
-                    history.append({
-                        "id": results['ids'][i],
-                        "document": results['documents'][i],
-                        "metadata": results['metadatas'][i]
-                    })
+                history = [
+                    {"id": doc_id, "document": document, "metadata": metadata}
+                    for doc_id, document, metadata in zip(
+                        results['ids'], results['documents'], results['metadatas']
+                    )
+                ]
                 
-                # Sort by timestamp (most recent last)
-                history.sort(key=lambda x: x['metadata'].get('timestamp', ''))
+                # Sort by timestamp (most recent last) and keep the latest turns
+                history.sort(key=_turn_order)
+                history = history[-limit:]
             
             return history
         except Exception as e:
@@ -252,40 +811,41 @@ class RAGService:
     
     def clear_session(self, session_id: str):
         """Clear all documents for a specific session"""
+        # Queued writes would otherwise land after the delete
+        self._wait_for_writes()
         try:
-            # Get all IDs for this session
-            results = self.collection.get(
-                where={"session_id": session_id},
-                include=[]
-            )
-            
-            if results and results['ids']:
-                self.collection.delete(ids=results['ids'])
+            self.collection.delete(where={"session_id": session_id})
+            self.chat_turns.delete(where={"session_id": session_id})
         except Exception as e:
             print(f"Error clearing session: {e}")
     
     def reset(self):
-        """Reset the entire collection (use with caution)"""
+        """Reset the email and chat turn collections (use with caution)"""
+        self._wait_for_writes()
         try:
-            self.client.delete_collection(name="email_chat_history")
-            self.collection = self.client.get_or_create_collection(
-                name="email_chat_history",
-                metadata={"description": "Email chat conversation history with RAG context"}
-            )
+            for name in (COLLECTION_NAME, CHAT_TURNS_COLLECTION_NAME):
+                try:
+                    self.client.delete_collection(name=name)
+                except NotFoundError:
+                    pass
+            with self._init_lock:
+                # Recreated on next access
+                self._collection = None
+                self._chat_turns = None
         except Exception as e:
             print(f"Error resetting collection: {e}")
     
     def clear_gmail_embeddings(self):
         """Clear only Gmail email embeddings when user disconnects from Gmail"""
+        self._wait_for_writes()
         try:
-            # Query for all Gmail emails (source=gmail in metadata)
-            results = self.collection.get(
-                where={"source": "gmail"}
-            )
+            # Delete all Gmail emails (source=gmail in metadata) in one call
+            result = self.collection.delete(where={"source": "gmail"})
             
-            if results and results['ids']:
-                self.collection.delete(ids=results['ids'])
-                print(f"Cleared {len(results['ids'])} Gmail email embeddings from RAG")
+            # Chroma reports how many were removed; older versions return None
+            deleted = (result or {}).get("deleted")
+            if deleted != 0:
+                print(f"Cleared {deleted if deleted is not None else 'all'} Gmail email embeddings from RAG")
             else:
                 print("No Gmail embeddings found to clear")
         except Exception as e:
@@ -293,20 +853,21 @@ class RAGService:
     
     def clear_mock_inbox_embeddings(self):
         """Clear only mock inbox embeddings when user logs in to Gmail"""
+        self._wait_for_writes()
         try:
-            # Query for all mock inbox emails (source=ingestion in metadata)
-            results = self.collection.get(
-                where={"source": "ingestion"}
-            )
+            # Delete all mock inbox emails (source=ingestion in metadata) in one call
+            result = self.collection.delete(where={"source": "ingestion"})
             
-            if results and results['ids']:
-                self.collection.delete(ids=results['ids'])
-                print(f"Cleared {len(results['ids'])} mock inbox email embeddings from RAG")
+            deleted = (result or {}).get("deleted")
+            if deleted != 0:
+                print(f"Cleared {deleted if deleted is not None else 'all'} mock inbox email embeddings from RAG")
             else:
                 print("No mock inbox embeddings found to clear")
         except Exception as e:
             print(f"Error clearing mock inbox embeddings: {e}")
 
 
-# Singleton instance
-rag_service = RAGService()
+@lru_cache(maxsize=1)
+def get_rag_service() -> RAGService:
+    """Shared RAGService, created the first time it's needed"""
+    return RAGService()
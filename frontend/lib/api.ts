@@ -8,6 +8,26 @@ export const api = {
         return res.json();
     },
 
+    getEmail: async (emailId: string): Promise<Email> => {
+        const res = await fetch(`${API_BASE}/emails/${emailId}`);
+        if (!res.ok) {
+            throw new Error("Unable to fetch email");
+        }
+        return res.json();
+    },
+
+    getEmailBodies: async (emailIds: string[]): Promise<Email[]> => {
+        const res = await fetch(`${API_BASE}/emails/bodies`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ ids: emailIds }),
+        });
+        if (!res.ok) {
+            throw new Error("Unable to fetch emails");
+        }
+        return res.json();
+    },
+
     ingestEmails: async (): Promise<{ message: string; emails: Email[] }> => {
         const res = await fetch(`${API_BASE}/ingest`, { method: "POST" });
         return res.json();
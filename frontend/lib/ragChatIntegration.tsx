@@ -293,7 +293,7 @@ export function ChatHistoryViewer({ sessionId }: { sessionId: string }) {
             {new Date(item.metadata.timestamp).toLocaleString()}
           </div>
           <div className="history-preview">
-            <strong>User:</strong> {item.metadata.user_message?.substring(0, 100)}...
+            <strong>User:</strong> {item.document?.split('\n')[0].replace(/^User: /, '').substring(0, 100)}...
           </div>
           {item.metadata.email_subject && (
             <div className="history-email-context">
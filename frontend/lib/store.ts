@@ -17,6 +17,15 @@ const filterEmailsForDisplay = (emails: Email[], status: GmailStatus | null) =>
     );
 };
 
+// Copy downloaded bodies into a list, for each email it holds
+const withBodies = (list: Email[], loaded: Email[]) => {
+    const byId = new Map(loaded.map((email) => [email.id, email]));
+    return list.map((email) => {
+        const match = byId.get(email.id);
+        return match ? { ...email, body: match.body, body_loaded: match.body_loaded } : email;
+    });
+};
+
 interface AppState {
     emails: Email[];
     allEmails: Email[];
@@ -36,6 +45,8 @@ interface AppState {
     updateSettings: (settings: Settings) => Promise<void>;
     setSelectedEmailId: (id: string | null) => void;
     setSelectedThreadEmails: (emails: Email[]) => void;
+    loadEmailBody: (id: string) => Promise<void>;
+    loadEmailBodies: (ids: string[]) => Promise<void>;
     resetInbox: () => Promise<void>;
     loadOAuthEmails: () => Promise<void>;
     toggleActionItem: (emailId: string, taskIndex: number) => void;
@@ -223,11 +234,40 @@ export const useStore = create<AppState>((set, get) => ({
                 };
             });
             api.markAsRead(id).catch(console.error);
+            get().loadEmailBody(id).catch(console.error);
         }
     },
 
     setSelectedThreadEmails: (emails) => {
         set({ selectedThreadEmails: emails });
+        get().loadEmailBodies(emails.map((email) => email.id)).catch(console.error);
+    },
+
+    loadEmailBody: async (id) => {
+        // Gmail messages are synced with headers only; fetch the body on first open
+        const email = get().allEmails.find((e) => e.id === id);
+        if (!email || email.body_loaded !== false) return;
+        const loaded = await api.getEmail(id);
+        set((state) => ({
+            emails: withBodies(state.emails, [loaded]),
+            allEmails: withBodies(state.allEmails, [loaded]),
+            selectedThreadEmails: withBodies(state.selectedThreadEmails, [loaded]),
+        }));
+    },
+
+    loadEmailBodies: async (ids) => {
+        // A thread's missing bodies are fetched in one request (one Gmail batch)
+        const missing = new Set(
+            get().allEmails.filter((e) => e.body_loaded === false).map((e) => e.id)
+        );
+        const pending = ids.filter((id) => missing.has(id));
+        if (pending.length === 0) return;
+        const loaded = await api.getEmailBodies(pending);
+        set((state) => ({
+            emails: withBodies(state.emails, loaded),
+            allEmails: withBodies(state.allEmails, loaded),
+            selectedThreadEmails: withBodies(state.selectedThreadEmails, loaded),
+        }));
     },
 
     toggleActionItem: (emailId, taskIndex) => {
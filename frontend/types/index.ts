@@ -3,6 +3,7 @@ export interface Email {
     sender: string;
     subject: string;
     body: string;
+    body_loaded?: boolean;
     timestamp: string;
     read: boolean;
     category?: string;